@@ -1,7 +1,11 @@
+import base64
 import os
+import struct
+from StringIO import StringIO
 
 from fabric.api import *
 from fabric.colors import red
+from fabric.contrib.files import exists
 
 from envs import ENVS
 import utils
@@ -23,16 +27,40 @@ def upload_release(version='HEAD'):
 
 @task
 def install_deps():
-    make_virtual_env()
-    install_requirements()
+    """
+    Link the current release to a virtualenv with its requirements.
+
+    Virtualenvs are kept in `api/venvs`, named by a hash of the release's
+    requirements file and Python interpreter, and are only built when no
+    release has used the same requirements before. uWSGI runs the virtualenv
+    linked into the current release.
+    """
+    require('hosts', 'project_path', provided_by=ENVS)
+    venv = 'venvs/{}'.format(get_requirements_hash())
+
+    with cd('{project_path}/api'.format(**env)):
+        if not exists('{}/.complete'.format(venv)):
+            make_virtual_env(venv)
+            install_requirements(venv)
+            run('touch {}/.complete'.format(venv))
+
+        run('ln -sfn ../../{} releases/current/venv'.format(venv))
+
+
+def get_requirements_hash():
+    "Hash of the current release's requirements and Python interpreter"
+    with cd('{project_path}/api/releases/current'.format(**env)):
+        return run('(cat requirements.txt; echo {python}) | '
+                   'sha256sum | cut -c 1-16'.format(**env)).strip()
 
 
 @task
-def make_virtual_env():
+def make_virtual_env(venv='venv'):
     with cd(env.project_path):
         with cd('api'):
-            run('virtualenv -p {python} --no-site-packages ./venv/'.format(
-                **env))
+            run('rm -rf {0} && '
+                'virtualenv -p {python} --no-site-packages ./{0}/'.format(
+                    venv, **env))
 
 
 @task
@@ -41,13 +69,86 @@ def deploy():
     Deploy the latest version of the API.
 
     Download the newest version of editorsnotes, install requirements in the
-    virtualenv, upload the virtual host, and restart the webserver.
+    virtualenv, upload the virtual host, and restart the webserver. Migrations
+    and static files are skipped if nothing they depend on has changed since
+    the previous release.
     """
     require('hosts', 'project_path', provided_by=ENVS)
+    install_settings()
+    migrate_if_changed()
+    collect_static_if_changed()
+
+
+def install_settings():
+    "Install the local settings and WSGI file for the current release"
     upload_local_settings()
     install_wsgi()
-    migrate()
-    collect_static()
+
+
+def migrate_if_changed():
+    utils.unless_unchanged('api', 'migrate', MIGRATE_INPUTS, migrate,
+                           shared_fingerprint=shared_fingerprint('migrate'))
+
+
+def collect_static_if_changed():
+    utils.unless_unchanged('api', 'collectstatic', STATIC_INPUTS,
+                           collect_static,
+                           shared_fingerprint=shared_fingerprint(
+                               'collectstatic'))
+
+
+def shared_fingerprint(step):
+    """
+    Path of the fingerprint of a step whose results all releases share: the
+    database, or the static files (kept out of the directory nginx serves)
+    """
+    require('project_path', provided_by=ENVS)
+    return os.path.join(env.project_path, 'api',
+                        '.{}-fingerprint'.format(step))
+
+
+# Files that migrations and collected static files depend on, for
+# `utils.unless_unchanged`. Requirements and settings decide which apps'
+# migrations and static files are used.
+MIGRATE_INPUTS = (". -type f \\( -path '*/migrations/*.py' "
+                  "-o -name requirements.txt -o -name 'settings*.py' \\) "
+                  "-print0")
+STATIC_INPUTS = (". -type f \\( -path '*/static/*' "
+                 "-o -name requirements.txt -o -name 'settings*.py' \\) "
+                 "-print0")
+
+
+@task
+def flush_response_cache():
+    """
+    Empty uWSGI's response cache, so that no documents rendered by an earlier
+    release are served from it.
+
+    The cache is cleared with a request in uWSGI's cache protocol to its
+    socket. It is kept by the uWSGI master, so it survives chain reloads but
+    not restarts.
+    """
+    require('hosts', 'python', 'uwsgi_socket_location', provided_by=ENVS)
+    packet = uwsgi_packet(111, 17, [('cmd', 'clear'), ('cache', 'api')])
+    cleared = sudo(
+        '{} -c "import base64, socket, sys; '
+        's = socket.socket(socket.AF_UNIX); s.connect(sys.argv[1]); '
+        's.sendall(base64.b64decode(sys.argv[2])); '
+        'print(b\'ok\' in s.recv(4096))" {} {}'.format(
+            env.python, env.uwsgi_socket_location, base64.b64encode(packet)),
+        quiet=True)
+    if cleared.strip() != 'True':
+        print red('Could not empty the uWSGI response cache on {}'.format(
+            env.host))
+
+
+def uwsgi_packet(modifier1, modifier2, values):
+    "A uwsgi protocol packet carrying a list of (key, value) strings."
+    body = ''.join(
+        struct.pack('<H', len(key)) + key +
+        struct.pack('<H', len(value)) + value
+        for key, value in values)
+    return struct.pack('<BHB', modifier1, len(body), modifier2) + body
 
 
 @task
@@ -55,7 +156,7 @@ def test():
     "Run the test suite remotely."
     require('hosts', 'project_path', provided_by=ENVS)
     with cd('{project_path}/api/releases/current'.format(**env)):
-        run('../../venv/bin/python manage.py test')
+        run('./venv/bin/python manage.py test')
 
 
 @task
@@ -63,7 +164,7 @@ def migrate():
     "Update the database for the current release"
     require('hosts', 'project_path', provided_by=ENVS)
     with cd('{project_path}/api/releases/current'.format(**env)):
-        run('../../venv/bin/python manage.py migrate --noinput')
+        run('./venv/bin/python manage.py migrate --noinput')
 
 
 def install_wsgi():
@@ -73,17 +174,45 @@ def install_wsgi():
 
 
 def upload_local_settings():
-    "Upload the appropriate local settings file."
+    """
+    Upload the appropriate local settings file.
+
+    If the API's database connections are pooled with PgBouncer, the settings
+    are changed to connect to it instead of directly to PostgreSQL.
+    """
     require('host', provided_by=ENVS)
     settings_file = 'settings/settings-{host}.py'.format(**env)
     if not os.path.exists(settings_file):
         abort(red('Put the settings for {} at {}'.format(
             env.host, settings_file)))
+
+    if env.get('pgbouncer'):
+        require('pgbouncer_port', provided_by=ENVS)
+        with open(settings_file) as f:
+            settings = f.read()
+        # Uploaded from memory, since hosts may be deployed to at once
+        settings_file = StringIO(settings + PGBOUNCER_SETTINGS.format(**env))
+
     put(settings_file,
         os.path.join(env.project_path, 'api', 'releases', 'current',
                      env.project_name, 'settings_local.py'))
 
 
+# Appended to the local settings when connections are pooled. Server-side
+# cursors cannot be used with transaction pooling, since the cursor's
+# transaction may not be on the same server connection as the next query.
+PGBOUNCER_SETTINGS = """
+
+# Connect through PgBouncer (added by `fab api.upload_local_settings`)
+for database in DATABASES.values():
+    database.update({{
+        'HOST': '127.0.0.1',
+        'PORT': '{pgbouncer_port}',
+        'DISABLE_SERVER_SIDE_CURSORS': True,
+    }})
+"""
+
+
 def get_deploy_info(version):
     with lcd(os.getenv('EDITORSNOTES_GIT')):
         release = local('git rev-parse {}'.format(version), capture=True)
@@ -133,12 +262,22 @@ def upload_deploy_info(version):
     local('rm {}'.format(time_file))
 
 
-def install_requirements():
-    "Install the required packages from the requirements file using pip"
+def install_requirements(venv='venv'):
+    """
+    Install the required packages from the requirements file using pip.
+
+    Packages are installed from wheels in `api/wheelhouse`, which is shared by
+    every release; only requirements without a wheel there are downloaded and
+    built.
+    """
     require('release', provided_by=ENVS)
     with cd('{project_path}/api'.format(**env)):
-        run('./venv/bin/pip install -r '
-            './releases/current/requirements.txt'.format(**env))
+        run('mkdir -p wheelhouse')
+        run('./{}/bin/pip wheel --wheel-dir ./wheelhouse '
+            '--find-links ./wheelhouse '
+            '-r ./releases/current/requirements.txt'.format(venv))
+        run('./{}/bin/pip install --no-index --find-links ./wheelhouse '
+            '-r ./releases/current/requirements.txt'.format(venv))
 
 
 @task
@@ -146,4 +285,5 @@ def collect_static():
     "Collect static files"
     require('hosts', 'project_path', provided_by=ENVS)
     with cd('{project_path}/api/releases/current'.format(**env)):
-        run('../../venv/bin/python manage.py collectstatic --noinput')
+        run('./venv/bin/python manage.py collectstatic --noinput')
+    utils.precompress_static(os.path.join(env.project_path, 'static'))
@@ -0,0 +1,384 @@
+"""
+HTTP load tests for a deployed site.
+
+Load is generated locally, with one keep-alive connection per simulated
+client, against the API (type-suffixed URLs), the renderer (HTML) and static
+files, following the routing in `nginx/nginx-TEMPLATE.conf.py`. Results are
+saved as JSON in `benchmarks/` so that runs can be compared.
+
+    fab envs.working_notes bench:concurrency=20,duration=60
+    fab bench.standin
+    fab bench.compare:benchmarks/a.json,benchmarks/b.json
+
+`full_deploy` can also compare the previous and new releases with these
+benchmarks, and roll back a deploy that makes latency worse.
+"""
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import json
+import math
+import os
+import re
+import threading
+import time
+import urlparse
+
+from fabric.api import *
+from fabric.colors import green, red
+
+from envs import ENVS
+import utils
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(env.real_fabfile), 'benchmarks')
+
+API_SUFFIX = re.compile(r'\.(json|jsonld|jsonld-browse|ttl|ttl-browse)$', re.I)
+
+# Paths requested for each backend, unless `bench_routes` is set
+DEFAULT_ROUTES = {
+    'api': ['/projects.json', '/projects.jsonld', '/projects.ttl'],
+    'renderer': ['/', '/projects/'],
+    'static': ['/static/rest_framework/css/bootstrap.min.css'],
+}
+
+# Accept header sent for each backend
+ACCEPT = {
+    'api': '*/*',
+    'renderer': 'text/html',
+    'static': '*/*',
+}
+
+
+def get_backend(path, accept):
+    "The backend nginx routes a request to, as in nginx-TEMPLATE.conf.py"
+    path = urlparse.urlsplit(path).path
+    if path.startswith('/static/') or path.startswith('/media/'):
+        return 'static'
+    if path.startswith('/auth/') or API_SUFFIX.search(path):
+        return 'api'
+    if path.endswith('.html') or 'html' in accept.lower():
+        return 'renderer'
+    return 'api'
+
+
+@task(default=True)
+def load(target=None, concurrency=10, duration=30, output=None,
+         bypass_cache=False):
+    """
+    Load test a site and save the results.
+
+    `target` defaults to the current host. Results are written to `output`, or
+    to a timestamped file in `benchmarks/`. With `bypass_cache`, requests carry
+    a session cookie so that nginx does not answer them from its cache.
+    """
+    if target is None:
+        require('host', provided_by=ENVS)
+        target = '{}://{}'.format(
+            'https' if env.get('ssl_conf_file') else 'http', env.host)
+
+    headers = {}
+    if bypass_cache and bypass_cache != 'False':
+        headers['Cookie'] = 'sessionid=bench'
+
+    routes = env.get('bench_routes') or DEFAULT_ROUTES
+    results = run_load(target, routes, int(concurrency), float(duration),
+                       headers)
+    print_results(results)
+    save_results(results, output)
+    return results
+
+
+@task
+def standin(concurrency=10, duration=5, delay=0.005, output=None):
+    """
+    Load test a local stand-in for the site, to try out the benchmark itself.
+
+    The stand-in server answers every backend's routes after `delay` seconds.
+    """
+    server = StandinServer(('127.0.0.1', 0), StandinHandler)
+    server.delay = float(delay)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        target = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        results = run_load(target, DEFAULT_ROUTES, int(concurrency),
+                           float(duration))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print_results(results)
+    save_results(results, output)
+    return results
+
+
+@task
+def compare(before, after):
+    "Print the difference in latency and throughput between two saved runs."
+    with open(before) as f:
+        before = json.load(f)
+    with open(after) as f:
+        after = json.load(f)
+
+    print '{:<10} {:>8} {:>22} {:>22} {:>22}'.format(
+        '', 'rps', 'p50', 'p95', 'p99')
+    for backend in sorted(after['backends']):
+        if backend not in before['backends']:
+            continue
+        b, a = before['backends'][backend], after['backends'][backend]
+        print '{:<10} {:>+7.1f}% {:>22} {:>22} {:>22}'.format(
+            backend,
+            percent_change(b['rps'], a['rps']),
+            *[format_change(b[stat], a[stat]) for stat in ('p50', 'p95',
+                                                           'p99')])
+
+
+def run_load(target, routes, concurrency, duration, headers=None):
+    """
+    Request the routes from `concurrency` clients for `duration` seconds,
+    sending any extra `headers` with each request.
+
+    Returns the summarized results (see `summarize`).
+    """
+    requests = [(backend, path) for backend in sorted(routes)
+                for path in routes[backend]]
+    samples = []
+    samples_lock = threading.Lock()
+    deadline = time.time() + duration
+
+    def client(offset):
+        connection = None
+        i = offset
+        client_samples = []
+        while time.time() < deadline:
+            backend, path = requests[i % len(requests)]
+            i += 1
+            if connection is None:
+                connection = make_connection(target)
+            start = time.time()
+            try:
+                request_headers = dict(headers or {},
+                                       Accept=ACCEPT[backend])
+                connection.request('GET', path, headers=request_headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (httplib.HTTPException, IOError):
+                connection.close()
+                connection = None
+                status = None
+            client_samples.append((backend, status, time.time() - start))
+        with samples_lock:
+            samples.extend(client_samples)
+
+    print green('Load testing {} with {} clients for {}s'.format(
+        target, concurrency, duration))
+
+    started = time.time()
+    clients = [threading.Thread(target=client, args=(n,))
+               for n in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - started
+
+    return summarize(samples, elapsed, target, concurrency)
+
+
+def make_connection(target):
+    parts = urlparse.urlsplit(target)
+    if parts.scheme == 'https':
+        return httplib.HTTPSConnection(parts.netloc, timeout=30)
+    return httplib.HTTPConnection(parts.netloc, timeout=30)
+
+
+def summarize(samples, elapsed, target, concurrency):
+    """
+    Summarize (backend, status, latency) samples into per-backend and overall
+    request rates, latency percentiles (in milliseconds) and error rates.
+    Raw latencies are kept so that runs can be compared statistically.
+    """
+    def stats(group):
+        latencies = [latency * 1000 for _, _, latency in group]
+        errors = [status for _, status, _ in group
+                  if status is None or status >= 400]
+        return {
+            'requests': len(group),
+            'rps': len(group) / elapsed if elapsed else 0,
+            'p50': utils.percentile(latencies, 50),
+            'p95': utils.percentile(latencies, 95),
+            'p99': utils.percentile(latencies, 99),
+            'error_rate': float(len(errors)) / len(group) if group else 0,
+            'latencies': latencies,
+        }
+
+    backends = sorted(set(backend for backend, _, _ in samples))
+    return {
+        'target': target,
+        'concurrency': concurrency,
+        'duration': elapsed,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'overall': stats(samples),
+        'backends': dict(
+            (backend, stats([s for s in samples if s[0] == backend]))
+            for backend in backends),
+    }
+
+
+def print_results(results):
+    print ''
+    print '{:<10} {:>8} {:>8} {:>9} {:>9} {:>9} {:>7}'.format(
+        '', 'requests', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'errors')
+
+    rows = sorted(results['backends'].items()) + [('overall',
+                                                   results['overall'])]
+    for name, stats in rows:
+        line = '{:<10} {:>8} {:>8.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>6.1f}%'.format(
+            name, stats['requests'], stats['rps'], stats['p50'] or 0,
+            stats['p95'] or 0, stats['p99'] or 0, stats['error_rate'] * 100)
+        print red(line) if stats['error_rate'] else line
+
+
+def save_results(results, output=None):
+    "Save results as JSON, returning the filename."
+    if output is None:
+        name = re.sub(r'\W+', '-', urlparse.urlsplit(results['target']).netloc)
+        output = os.path.join(RESULTS_DIR, '{}-{}.json'.format(
+            name, time.strftime('%Y%m%d%H%M%S')))
+
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+
+    with open(output, 'w') as f:
+        json.dump(results, f)
+
+    print '\nSaved results to {}'.format(output)
+    return output
+
+
+def find_regressions(before, after, budget, significance=0.05):
+    """
+    Compare two runs, returning a description of each regression.
+
+    A run with a higher error rate than the one before it, overall or for any
+    backend, has regressed whatever its latency, since failed requests are
+    often answered quickly. Only if no error rate went up are backends
+    checked for p95 latency that got worse by more than `budget` percent.
+
+    A backend only counts as slower if its latencies after are also
+    significantly greater than before, by a one-sided Mann-Whitney U test, so
+    that noise in the tail of a short run does not fail a deploy.
+    """
+    regressions = find_error_regressions(before, after)
+    if regressions:
+        return regressions
+
+    for backend in sorted(after['backends']):
+        if backend not in before['backends']:
+            continue
+        b, a = before['backends'][backend], after['backends'][backend]
+        change = percent_change(b['p95'], a['p95'])
+        if change <= budget:
+            continue
+        p_value = mann_whitney_p(b['latencies'], a['latencies'])
+        if p_value < significance:
+            regressions.append(
+                '{}: p95 {:.1f}ms -> {:.1f}ms ({:+.1f}%, p={:.4f})'.format(
+                    backend, b['p95'], a['p95'], change, p_value))
+    return regressions
+
+
+def find_error_regressions(before, after):
+    "Describe each backend, and the run overall, whose error rate went up."
+    rows = [('overall', before['overall'], after['overall'])]
+    rows += [(backend, before['backends'].get(backend),
+              after['backends'][backend])
+             for backend in sorted(after['backends'])]
+
+    regressions = []
+    for name, b, a in rows:
+        b_rate = b['error_rate'] if b else 0
+        if a['error_rate'] > b_rate:
+            regressions.append('{}: error rate {:.1f}% -> {:.1f}%'.format(
+                name, b_rate * 100, a['error_rate'] * 100))
+    return regressions
+
+
+def mann_whitney_p(before, after):
+    """
+    One-sided p-value for `after` tending to be greater than `before`, from a
+    Mann-Whitney U test (normal approximation, with a correction for ties).
+    """
+    n1, n2 = len(before), len(after)
+    if not n1 or not n2:
+        return 1.0
+
+    values = sorted([(v, 0) for v in before] + [(v, 1) for v in after])
+    rank_sum = 0.0
+    tie_term = 0.0
+    i = 0
+    while i < len(values):
+        j = i
+        while j < len(values) and values[j][0] == values[i][0]:
+            j += 1
+        # Tied values share the average of their ranks (ranks start at 1)
+        rank = (i + j + 1) / 2.0
+        rank_sum += rank * sum(1 for v in values[i:j] if v[1] == 1)
+        tie_term += (j - i) ** 3 - (j - i)
+        i = j
+
+    n = n1 + n2
+    u = rank_sum - n2 * (n2 + 1) / 2.0
+    mean = n1 * n2 / 2.0
+    variance = n1 * n2 / 12.0 * ((n + 1) - tie_term / (n * (n - 1)))
+    if variance <= 0:
+        return 1.0
+
+    z = (u - mean) / math.sqrt(variance)
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def percent_change(before, after):
+    return (after - before) * 100.0 / before if before else 0
+
+
+def format_change(before, after):
+    return '{:.1f} -> {:.1f} ({:+.1f}%)'.format(
+        before or 0, after or 0, percent_change(before, after))
+
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    delay = 0
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Answers requests with a small body of the type its backend would serve."
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    BODIES = {
+        'api': ('application/ld+json', '{"@id": "stand-in"}'),
+        'renderer': ('text/html', '<!doctype html><p>stand-in</p>'),
+        'static': ('text/css', 'body {}\n' * 512),
+    }
+
+    def do_GET(self):
+        backend = get_backend(self.path, self.headers.get('Accept', ''))
+        content_type, body = self.BODIES[backend]
+        time.sleep(self.server.delay)
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
@@ -13,6 +13,14 @@ def make_basic_conf(hostname):
     env.python = '/usr/bin/python3'
     env.node_bin = '/usr/bin/node'
 
+    # How releases are uploaded: 'tar' sends a full package, 'rsync' sends
+    # only the files that changed since the current release
+    env.upload_method = 'tar'
+
+    # Skip migrations, collecting static files and compiling the renderer
+    # when nothing they depend on changed since the previous release
+    env.deploy_skip_unchanged = True
+
     env.uwsgi_bin = '/usr/sbin/uwsgi'
     env.uwsgi_conf_file = '/etc/uwsgi.d/{}.ini'.format(hostname)
     env.uwsgi_uid = 'ryanshaw'
@@ -23,11 +31,113 @@ def make_basic_conf(hostname):
     env.uwsgi_socket_uid = 'nginx'
     env.uwsgi_socket_gid = 'nginx'
     env.uwsgi_socket_chmod = 644
+    env.uwsgi_master_fifo = '/run/uwsgi/{}.fifo'.format(hostname)
+    env.uwsgi_stats_socket = '/run/uwsgi/{}.stats.sock'.format(hostname)
+
+    # uWSGI worker pool. Leave `uwsgi_processes`, `uwsgi_cheaper` and
+    # `uwsgi_cheaper_initial` as None to derive them from the number of cores
+    # on the target host. Set `uwsgi_cheaper` to 0 to disable adaptive
+    # spawning.
+    env.uwsgi_processes = None
+    env.uwsgi_threads = 2
+    env.uwsgi_cheaper = None
+    env.uwsgi_cheaper_initial = None
+    env.uwsgi_cheaper_step = 1
+    env.uwsgi_listen = 1024
+    env.uwsgi_harakiri = 60
+    env.uwsgi_max_requests = 5000
+    env.uwsgi_buffer_size = 32768
+
+    # Response cache in uWSGI, shared by its workers, for anonymous requests
+    # for API documents with a type suffix (.json, .jsonld, .ttl).
+    # `uwsgi_cache_size` is in megabytes, divided into blocks of
+    # `uwsgi_cache_blocksize` bytes. Responses are kept for
+    # `uwsgi_cache_expires` seconds, or until the next API deploy.
+    env.uwsgi_cache = False
+    env.uwsgi_cache_size = 64
+    env.uwsgi_cache_items = 2000
+    env.uwsgi_cache_blocksize = 4096
+    env.uwsgi_cache_expires = 300
+
+    # Pool the API's database connections with PgBouncer in transaction
+    # mode. It listens on `pgbouncer_port`, and the API's settings are
+    # pointed at it when they are uploaded. `pgbouncer_auth_file` must list
+    # the API's database user and password, and already exist on the server.
+    env.pgbouncer = False
+    env.pgbouncer_bin = '/usr/bin/pgbouncer'
+    env.pgbouncer_conf_file = '/etc/pgbouncer/{}.ini'.format(hostname)
+    env.pgbouncer_user = 'pgbouncer'
+    env.pgbouncer_group = 'pgbouncer'
+    env.pgbouncer_auth_type = 'scram-sha-256'
+    env.pgbouncer_auth_file = '/etc/pgbouncer/userlist.txt'
+    env.pgbouncer_pool_size = 20
+    env.pgbouncer_reserve_pool_size = 5
+    env.pgbouncer_max_client_conn = 500
+    env.postgres_host = '127.0.0.1'
+    env.postgres_port = 5432
 
     env.nginx_conf_file = '/etc/nginx/conf.d/{}.conf'.format(hostname)
+    env.nginx_access_log = '/var/log/nginx/access.log'
+    env.nginx_json_access_log = '/var/log/nginx/{}.access.json'.format(
+        hostname)
+
+    # Number of renderer processes, on consecutive ports from `renderer_port`
+    # (None runs one per core). Make sure the range does not include
+    # `markup_renderer_port`. `reload_all_services` needs at least two, so
+    # that one can serve while the other restarts.
+    env.renderer_instances = 2
+
+    # Idle keepalive connections nginx holds open to the renderer
+    env.renderer_keepalive = 32
+
+    # Browser caching of static files and uploads. Files with a content hash
+    # in their name are always cached indefinitely. Only enable
+    # `nginx_brotli_static` if nginx was built with the ngx_brotli module.
+    env.nginx_static_expires = '1h'
+    env.nginx_brotli_static = False
+
+    # Microcaching of anonymous renderer and API responses in nginx
+    env.nginx_cache = False
+    env.nginx_cache_dir = '/var/cache/nginx'
+    env.nginx_cache_keys_zone_size = '10m'
+    env.nginx_cache_max_size = '1g'
+    env.nginx_cache_inactive = '10m'
+    env.nginx_cache_ttl = '5s'
 
     env.ssl_conf_file = '/usr/local/projects/workingnotes_ssl.conf'
 
+    # TLS tuning for the HTTPS server. Set any of these to None if
+    # `ssl_conf_file` already sets the same directive. Enable
+    # `nginx_ssl_stapling` only once `ssl_conf_file` sets `resolver` and
+    # `ssl_trusted_certificate`.
+    env.nginx_http2 = True
+    env.nginx_ssl_session_cache = '10m'
+    env.nginx_ssl_session_timeout = '1d'
+    env.nginx_ssl_session_tickets = False
+    env.nginx_ssl_stapling = False
+    env.nginx_ssl_buffer_size = '4k'
+
+    # Post-deploy warmup. URLs are listed one path per line in
+    # `warmup_urls_file`; without it, the most requested paths in
+    # `nginx_json_access_log` are used. A deploy is rolled back if the p95
+    # latency of the last warmup round exceeds `warmup_max_latency` seconds.
+    env.warmup_urls_file = 'warmup/{}.txt'.format(hostname)
+    env.warmup_sample_size = 50
+    env.warmup_rounds = 2
+    env.warmup_concurrency = 4
+    env.warmup_max_latency = 2.0
+    env.warmup_gate = True
+
+    # Serve uWSGI, nginx and renderer statistics in the Prometheus text
+    # format at http://127.0.0.1:{metrics_port}/metrics. nginx's own
+    # statistics are read from its loopback-only server on
+    # `nginx_internal_port`, which the renderer also uses for API requests.
+    env.metrics = False
+
+    # Load used to benchmark releases with `full_deploy:bench_budget=...`
+    env.bench_gate_concurrency = 10
+    env.bench_gate_duration = 30
+
 
 @task
 def working_notes_test():
@@ -35,7 +145,17 @@ def working_notes_test():
     hostname = 'test.workingnotes.org'
     make_basic_conf(hostname)
     env.renderer_port = 15023
+    env.renderer_ports = [15023, 15033]
     env.markup_renderer_port = 15024
+    env.nginx_internal_port = 15027
+    env.metrics_port = 15028
+    env.pgbouncer_port = 15031
+
+    # Pinned, rather than sized from the host's cores, so that the committed
+    # configuration files can be regenerated anywhere
+    env.uwsgi_processes = 4
+    env.uwsgi_cheaper = 1
+    env.uwsgi_cheaper_initial = 1
 
 
 @task
@@ -44,7 +164,17 @@ def working_notes():
     hostname = 'workingnotes.org'
     make_basic_conf(hostname)
     env.renderer_port = 15025
+    env.renderer_ports = [15025, 15034]
     env.markup_renderer_port = 15026
+    env.nginx_internal_port = 15029
+    env.metrics_port = 15030
+    env.pgbouncer_port = 15032
+
+    # Pinned, rather than sized from the host's cores, so that the committed
+    # configuration files can be regenerated anywhere
+    env.uwsgi_processes = 4
+    env.uwsgi_cheaper = 1
+    env.uwsgi_cheaper_initial = 1
 
 
 @task
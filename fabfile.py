@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from fabric.api import *
-from fabric.colors import red
+from fabric.colors import green, red
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists
 
@@ -15,6 +15,10 @@ import envs
 import api
 import renderer
 import markup_renderer
+import utils
+import warmup
+import bench
+import logs
 
 
 ####################
@@ -23,11 +27,18 @@ import markup_renderer
 env.project_name = 'editorsnotes'
 env.release = time.strftime('%Y%m%d%H%M%S')
 env.TMP_DIR = os.path.join(os.path.dirname(env.real_fabfile), 'tmp')
+env.PACKAGE_CACHE_DIR = os.path.join(
+    os.path.dirname(env.real_fabfile), 'packages')
+
+HOST_CPU_COUNTS = {}
 
 env.git = {}
 env.git['api'] = os.getenv('EDITORSNOTES_API_GIT')
 env.git['renderer'] = os.getenv('EDITORSNOTES_RENDERER_GIT')
 
+# Number of hosts deployed to at once by `parallel_deploy`
+env.deploy_pool_size = 4
+
 if not env.git['api']:
     abort(red(
         'Set EDITORSNOTES_API_GIT environment variable with a path to an '
@@ -52,6 +63,11 @@ def create_confs():
     create_api_service()
     create_renderer_service()
     create_markup_renderer_service()
+    if env.get('metrics'):
+        create_metrics_exporter_service()
+    if env.get('pgbouncer'):
+        create_pgbouncer_conf()
+        create_pgbouncer_service()
     create_systemd_target()
 
 
@@ -90,9 +106,28 @@ def create_uwsgi_conf():
         'uwsgi_uid',
         'uwsgi_socket_gid',
         'uwsgi_socket_uid',
-        'uwsgi_socket_chmod'
+        'uwsgi_socket_chmod',
+        'uwsgi_processes',
+        'uwsgi_threads',
+        'uwsgi_cheaper',
+        'uwsgi_cheaper_initial',
+        'uwsgi_cheaper_step',
+        'uwsgi_listen',
+        'uwsgi_harakiri',
+        'uwsgi_max_requests',
+        'uwsgi_buffer_size',
+        'uwsgi_master_fifo',
+        'metrics',
+        'uwsgi_stats_socket',
+        'uwsgi_cache',
+        'uwsgi_cache_size',
+        'uwsgi_cache_items',
+        'uwsgi_cache_blocksize',
+        'uwsgi_cache_expires',
     ]
 
+    set_uwsgi_worker_defaults()
+
     output_filename = 'uwsgi/uwsgi-{host}.ini'.format(**env)
     uwsgi_conf = create_template(
         template_vars, './uwsgi/uwsgi-TEMPLATE.ini.py')
@@ -100,16 +135,70 @@ def create_uwsgi_conf():
     write_config('uWSGI', output_filename, uwsgi_conf)
 
 
+def set_uwsgi_worker_defaults():
+    """
+    Fill in any uWSGI worker counts left unset by the environment.
+
+    Workers are sized from the core count of the target host: two processes
+    per core, with the cheaper subsystem idling down to half a process per
+    core.
+    """
+    require('host', provided_by=envs.ENVS)
+
+    if None not in (env.get('uwsgi_processes'),
+                    env.get('uwsgi_cheaper'),
+                    env.get('uwsgi_cheaper_initial')):
+        return
+
+    cores = get_host_cpu_count()
+
+    if env.get('uwsgi_processes') is None:
+        env.uwsgi_processes = max(2, cores * 2)
+    if env.get('uwsgi_cheaper') is None:
+        env.uwsgi_cheaper = max(1, cores // 2)
+    if env.get('uwsgi_cheaper_initial') is None:
+        env.uwsgi_cheaper_initial = env.uwsgi_cheaper
+
+
+def get_host_cpu_count():
+    "Number of processing units available on the current host."
+    require('host', provided_by=envs.ENVS)
+    if env.host not in HOST_CPU_COUNTS:
+        HOST_CPU_COUNTS[env.host] = int(run('nproc', quiet=True) or 1)
+    return HOST_CPU_COUNTS[env.host]
+
+
 @task
 def create_nginx_conf():
     template_vars = [
         'host',
         'project_path',
         'uwsgi_socket_location',
-        'renderer_port',
-        'ssl_conf_file'
+        'renderer_port_list',
+        'nginx_cache',
+        'nginx_cache_dir',
+        'nginx_cache_keys_zone_size',
+        'nginx_cache_max_size',
+        'nginx_cache_inactive',
+        'nginx_cache_ttl',
+        'renderer_keepalive',
+        'nginx_static_expires',
+        'nginx_brotli_static',
+        'nginx_access_log',
+        'nginx_json_access_log',
+        'metrics',
+        'nginx_internal_port',
+        'nginx_http2',
+        'nginx_ssl_session_cache',
+        'nginx_ssl_session_timeout',
+        'nginx_ssl_session_tickets',
+        'nginx_ssl_stapling',
+        'nginx_ssl_buffer_size',
+        'ssl_conf_file',
     ]
 
+    env.renderer_port_list = ','.join(map(str, get_renderer_ports()))
+
     output_filename = 'nginx/nginx-{host}.conf'.format(**env)
     nginx_conf = create_template(
         template_vars, './nginx/nginx-TEMPLATE.conf.py')
@@ -117,12 +206,42 @@ def create_nginx_conf():
     write_config('Nginx', output_filename, nginx_conf)
 
 
+def get_renderer_ports():
+    """
+    Ports of every renderer instance for this host.
+
+    Unless `renderer_ports` is set, `renderer_instances` instances run on
+    consecutive ports starting at `renderer_port`. If `renderer_instances` is
+    None, one instance is run for each core on the host.
+    """
+    require('renderer_port', provided_by=envs.ENVS)
+
+    ports = env.get('renderer_ports')
+    if not ports:
+        instances = env.get('renderer_instances', 1)
+        if instances is None:
+            instances = get_host_cpu_count()
+        ports = range(env.renderer_port, env.renderer_port + instances)
+
+    if env.get('markup_renderer_port') in ports:
+        abort(red('Renderer ports for {} ({}) overlap the markup renderer '
+                  'port ({}).'.format(env.host, ', '.join(map(str, ports)),
+                                      env.markup_renderer_port)))
+
+    return ports
+
+
 @task
 def create_systemd_target():
     template_vars = [
-        'host'
+        'host',
+        'renderer_port_list',
+        'metrics',
+        'pgbouncer',
     ]
 
+    env.renderer_port_list = ','.join(map(str, get_renderer_ports()))
+
     output_filename = 'systemd/{host}.target'.format(**env)
     systemd_target = create_template(
         template_vars, './systemd/TEMPLATE.target.py')
@@ -155,12 +274,12 @@ def create_renderer_service():
         'host',
         'node_bin',
         'project_path',
-        'renderer_port',
+        'nginx_internal_port',
     ]
 
-    output_filename = 'systemd/{host}.renderer.service'.format(**env)
+    output_filename = 'systemd/{host}.renderer@.service'.format(**env)
     renderer_service = create_template(
-        template_vars, './systemd/TEMPLATE.renderer.service.py')
+        template_vars, './systemd/TEMPLATE.renderer@.service.py')
 
     write_config('Renderer service', output_filename, renderer_service)
 
@@ -181,6 +300,68 @@ def create_markup_renderer_service():
     write_config('Markup renderer service', output_filename, renderer_service)
 
 
+@task
+def create_metrics_exporter_service():
+    template_vars = [
+        'host',
+        'python',
+        'project_path',
+        'metrics_port',
+        'uwsgi_stats_socket',
+        'nginx_internal_port',
+        'renderer_port_list',
+        'uwsgi_socket_uid',
+        'uwsgi_socket_gid',
+    ]
+
+    env.renderer_port_list = ','.join(map(str, get_renderer_ports()))
+
+    output_filename = 'systemd/{host}.metrics-exporter.service'.format(**env)
+    exporter_service = create_template(
+        template_vars, './systemd/TEMPLATE.metrics-exporter.service.py')
+
+    write_config('Metrics exporter service', output_filename,
+                 exporter_service)
+
+
+@task
+def create_pgbouncer_conf():
+    template_vars = [
+        'host',
+        'pgbouncer_port',
+        'postgres_host',
+        'postgres_port',
+        'pgbouncer_auth_type',
+        'pgbouncer_auth_file',
+        'pgbouncer_pool_size',
+        'pgbouncer_reserve_pool_size',
+        'pgbouncer_max_client_conn',
+    ]
+
+    output_filename = 'pgbouncer/pgbouncer-{host}.ini'.format(**env)
+    pgbouncer_conf = create_template(
+        template_vars, './pgbouncer/pgbouncer-TEMPLATE.ini.py')
+
+    write_config('PgBouncer', output_filename, pgbouncer_conf)
+
+
+@task
+def create_pgbouncer_service():
+    template_vars = [
+        'host',
+        'pgbouncer_bin',
+        'pgbouncer_conf_file',
+        'pgbouncer_user',
+        'pgbouncer_group',
+    ]
+
+    output_filename = 'systemd/{host}.pgbouncer.service'.format(**env)
+    pgbouncer_service = create_template(
+        template_vars, './systemd/TEMPLATE.pgbouncer.service.py')
+
+    write_config('PgBouncer service', output_filename, pgbouncer_service)
+
+
 @task
 def setup():
     """
@@ -199,68 +380,133 @@ def setup():
         make_release_folders('api')
         make_release_folders('renderer')
 
+    if env.get('pgbouncer'):
+        check_pgbouncer_auth_file()
+
+
+def check_pgbouncer_auth_file():
+    "Make sure PgBouncer's user list exists before pointing the API at it."
+    require('pgbouncer_auth_file', provided_by=envs.ENVS)
+    if not exists(env.pgbouncer_auth_file, use_sudo=True):
+        abort(red('PgBouncer is enabled for {}, but its user list ({}) does '
+                  'not exist. Create it on the server, listing the API\'s '
+                  'database user, or set `pgbouncer = False`.'.format(
+                      env.host, env.pgbouncer_auth_file)))
+
+
+@task
+def install_configs():
+    """
+    Install every configuration file and systemd unit for the current host.
+
+    Files are uploaded together and installed by a single remote command,
+    which only replaces files that changed and only reloads the services
+    whose files changed.
+    """
+    # Units come first, so that systemd reloads them before other services
+    # are reloaded
+    files = systemd_unit_files() + nginx_conf_files() + uwsgi_conf_files()
+    if env.get('pgbouncer'):
+        check_pgbouncer_auth_file()
+        files += pgbouncer_conf_files()
+
+    utils.install_files(files)
+
 
 @task
 def upload_uwsgi_conf():
-    require('uwsgi_conf_file', 'host', provided_by=envs.ENVS)
-    uwsgi_file = 'uwsgi/uwsgi-{host}.ini'.format(**env)
+    utils.install_files(uwsgi_conf_files())
 
-    check_file(uwsgi_file)
 
-    put(uwsgi_file, '{project_path}/conf/uwsgi.ini.tmp'.format(**env))
-    with cd(env.project_path):
-        sudo('chmod 644 conf/uwsgi.ini.tmp')
-        sudo('chown uwsgi:uwsgi conf/uwsgi.ini.tmp')
-        sudo('mv -f conf/uwsgi.ini.tmp {uwsgi_conf_file}'
-             .format(**env), pty=True)
+@task
+def upload_pgbouncer_conf():
+    utils.install_files(pgbouncer_conf_files())
 
 
 @task
 def upload_nginx_conf():
+    utils.install_files(nginx_conf_files())
+
+
+@task
+def install_systemd_services():
+    utils.install_files(systemd_unit_files())
+
+
+# Each of the following returns the files to install for one service, as
+# (local path, remote path, owner, mode, reload command) tuples for
+# `utils.install_files`. uWSGI reads its configuration only when it is
+# started, so it is not reloaded here.
+
+def uwsgi_conf_files():
+    require('uwsgi_conf_file', 'host', provided_by=envs.ENVS)
+    uwsgi_file = 'uwsgi/uwsgi-{host}.ini'.format(**env)
+    check_file(uwsgi_file)
+    return [(uwsgi_file, env.uwsgi_conf_file, 'uwsgi:uwsgi', 0644, None)]
+
+
+def pgbouncer_conf_files():
+    require('pgbouncer_conf_file', 'host', provided_by=envs.ENVS)
+    pgbouncer_file = 'pgbouncer/pgbouncer-{host}.ini'.format(**env)
+    check_file(pgbouncer_file)
+    return [(pgbouncer_file, env.pgbouncer_conf_file,
+             'root:{}'.format(env.pgbouncer_group), 0640,
+             'systemctl try-reload-or-restart {}.pgbouncer.service'.format(
+                 env.host))]
+
+
+def nginx_conf_files():
     require('nginx_conf_file', 'host', provided_by=envs.ENVS)
     nginx_file = 'nginx/nginx-{host}.conf'.format(**env)
-
     check_file(nginx_file)
-
-    put(nginx_file, '{project_path}/conf/nginx.conf.tmp'.format(**env))
-    with cd(env.project_path):
-        sudo('chown root:root conf/nginx.conf.tmp')
-        sudo('chmod 644 conf/nginx.conf.tmp')
-        sudo('mv -f conf/nginx.conf.tmp {nginx_conf_file}'.format(**env),
-             pty=True)
+    return [(nginx_file, env.nginx_conf_file, 'root:root', 0644,
+             'nginx -t -q && systemctl try-reload-or-restart nginx.service')]
 
 
-@task
-def install_systemd_services():
+def systemd_unit_files():
     require('host', 'project_path', provided_by=envs.ENVS)
 
     units = [
         'api.service',
-        'renderer.service',
+        'renderer@.service',
         'markup-renderer.service',
         'target'
     ]
 
+    if env.get('pgbouncer'):
+        units.append('pgbouncer.service')
+
+    if env.get('metrics'):
+        units.append('metrics-exporter.service')
+
+    files = []
     for unit in units:
         unit_file = '{}.{}'.format(env.host, unit)
         local_conf = 'systemd/{}'.format(unit_file)
         check_file(local_conf)
-        put(local_conf, '{}/conf/{}.tmp'.format(env.project_path, unit_file))
-        with cd(os.path.join(env.project_path, 'conf')):
-            sudo('chown root:root {}.tmp'.format(unit_file))
-            sudo('chmod 644 {}.tmp'.format(unit_file))
-            sudo('mv -f {0}.tmp /etc/systemd/system/{0}'.format(unit_file))
+        files.append((local_conf, '/etc/systemd/system/{}'.format(unit_file),
+                      'root:root', 0644, 'systemctl daemon-reload'))
 
-    make_uwsgi_run_dir()
-    sudo('systemctl daemon-reload')
+    if env.get('metrics'):
+        files.append((
+            'metrics/metrics_exporter.py',
+            '{}/conf/metrics_exporter.py'.format(env.project_path),
+            'root:root', 0755,
+            'systemctl try-restart {}.metrics-exporter.service'.format(
+                env.host)))
+
+    return files
 
 
 @task
 def remove_systemd_services():
     units = [
         'api.service',
+        'renderer@.service',
         'renderer.service',
         'markup-renderer.service',
+        'metrics-exporter.service',
+        'pgbouncer.service',
         'target'
     ]
 
@@ -273,10 +519,97 @@ def remove_systemd_services():
 @task
 def restart_all_services():
     require('host', provided_by=envs.ENVS)
-    make_uwsgi_run_dir()
     sudo('systemctl restart {}.target nginx.service'.format(env.host))
 
 
+@task
+def reload_all_services():
+    """
+    Reload every service for the current host without dropping requests.
+
+    uWSGI workers are replaced one at a time (chain reloading), each new worker
+    loading the application before the next old one is stopped. A uWSGI
+    started from an older configuration without a master FIFO is restarted
+    instead. Renderer instances are restarted one at a time, waiting for each
+    to respond before moving on, while nginx sends requests to the others, so
+    there must be at least two. There is only one markup renderer, so it is
+    only restarted if a new version was installed since it started. nginx
+    reloads its configuration in place. If the site is not running, it is
+    started.
+    """
+    require('host', 'uwsgi_master_fifo', 'markup_renderer_port',
+            provided_by=envs.ENVS)
+
+    if sudo('systemctl is-active {}.target'.format(env.host),
+            quiet=True).failed:
+        restart_all_services()
+        return
+
+    renderer_ports = get_renderer_ports()
+    if len(renderer_ports) < 2:
+        abort(red('{} runs a single renderer instance, which cannot be '
+                  'restarted without failing requests for pages. Run at '
+                  'least two (see `renderer_instances`), or use '
+                  'restart_all_services.'.format(env.host)))
+
+    chain_reload_api()
+
+    # The master keeps its response cache across a chain reload, and old
+    # workers may have filled it until they were replaced
+    if env.get('uwsgi_cache'):
+        api.flush_response_cache()
+
+    for port in renderer_ports:
+        sudo('systemctl restart {}.renderer@{}.service'.format(env.host, port))
+        wait_for_port(port)
+
+    if markup_renderer.installed_since_start():
+        print red('Restarting the markup renderer on {}; the API cannot '
+                  'render markup until it is back.'.format(env.host))
+        sudo('systemctl restart {}.markup-renderer.service'.format(env.host))
+        wait_for_port(env.markup_renderer_port)
+
+    sudo('systemctl reload nginx.service')
+
+
+def chain_reload_api(timeout=120):
+    """
+    Replace the API's uWSGI workers one at a time, waiting until the last of
+    them has been replaced.
+
+    uWSGI started from a configuration without a master FIFO is restarted
+    instead, since writing to a FIFO that does not exist only creates a file.
+    """
+    require('host', 'uwsgi_master_fifo', provided_by=envs.ENVS)
+
+    if sudo('test -p {uwsgi_master_fifo}'.format(**env), quiet=True).failed:
+        sudo('systemctl restart {}.api.service'.format(env.host))
+        return
+
+    # uWSGI logs when the last worker of a chain reload has been replaced
+    reloaded = sudo(
+        'since=@$(date +%s); echo c > {fifo}; '
+        'for i in $(seq {timeout}); do sleep 1; '
+        'journalctl --quiet --no-pager --output=cat --since=$since '
+        '--unit={host}.api.service | grep -q "chain reloading complete" '
+        '&& exit 0; done; exit 1'.format(
+            fifo=env.uwsgi_master_fifo, timeout=timeout, host=env.host),
+        quiet=True)
+    if reloaded.failed:
+        abort(red('uWSGI on {} did not finish reloading after {} seconds.'
+                  .format(env.host, timeout)))
+
+
+def wait_for_port(port, timeout=30):
+    "Wait until an HTTP server on the current host responds on a local port."
+    check = 'curl -s -o /dev/null --max-time 5 http://127.0.0.1:{}/'.format(
+        port)
+    if run('for i in $(seq {0}); do {1} && exit 0; sleep 1; done; exit 1'
+           .format(timeout, check), quiet=True).failed:
+        abort(red('Nothing responding on port {} of {} after {} seconds.'
+                  .format(port, env.host, timeout)))
+
+
 def check_file(filename):
     if not os.path.exists(filename):
         abort(red('Missing config file for {} at {}'.format(
@@ -303,28 +636,232 @@ def make_release_folders(dirname):
 
 @task
 def full_deploy(api_version='HEAD', renderer_version='HEAD',
-                markup_renderer_version=None):
+                markup_renderer_version=None, bench_budget=None):
     """
     Deploy the site, migrate the database, and open in a web browser.
+
+    If `bench_budget` is given, the running release is benchmarked before the
+    deploy and the new one after it (restarting services to run it). The deploy
+    is rolled back if the p95 latency of any backend significantly regresses
+    by more than `bench_budget` percent.
     """
     setup()
 
+    if bench_budget is not None:
+        before = benchmark_release()
+
     api.full_deploy(api_version)
     renderer.full_deploy(renderer_version)
     markup_renderer.full_deploy(markup_renderer_version)
 
-    upload_nginx_conf()
-    upload_uwsgi_conf()
-    install_systemd_services()
+    install_configs()
+
+    if bench_budget is not None:
+        check_benchmark_regressions(before, float(bench_budget))
+
+
+def benchmark_release():
+    "Benchmark the release running on the current host."
+    return bench.load(concurrency=env.bench_gate_concurrency,
+                      duration=env.bench_gate_duration,
+                      bypass_cache=True)
+
+
+def check_benchmark_regressions(before, budget):
+    """
+    Benchmark the newly deployed release, rolling it back if it fails to warm
+    up, fails more requests than the `before` benchmark, or is slower than it
+    by more than `budget` percent.
+    """
+    if before['overall']['error_rate'] == 1:
+        print red('Every request to the previous release failed; '
+                  'not comparing benchmarks.')
+        return
+
+    # Restart, rather than reload, so that configuration installed by this
+    # deploy is measured too, and warm the new release up as the previous one
+    # was before it was measured
+    restart_all_services()
+    time.sleep(2)
+    if not warmup.warmup():
+        rollback()
+        abort(red('Rolled back {} after a failed warmup.'.format(env.host)))
+    after = benchmark_release()
+
+    regressions = bench.find_regressions(before, after, budget)
+    if regressions:
+        rollback()
+        abort(red('Rolled back {} after the benchmark regressed:\n  {}'
+                  .format(env.host, '\n  '.join(regressions))))
+
+    print green('No error or latency regressions over {}%'.format(budget))
+
+
+@task
+def rollback():
+    """
+    Switch the API and renderer back to their previous releases and restart.
+    """
+    require('host', provided_by=envs.ENVS)
+
+    # Check both first, so that neither is rolled back without the other
+    missing = [project for project in ('api', 'renderer')
+               if not utils.has_previous_release(project)]
+    if missing:
+        abort(red('Cannot roll back {}: there is no previous release of '
+                  '{}.'.format(env.host, ' or '.join(missing))))
+
+    utils.rollback_release('api')
+    utils.rollback_release('renderer')
+    restart_all_services()
+
+
+@task
+@runs_once
+def parallel_deploy(*env_names, **kwargs):
+    """
+    Deploy to several environments at once.
+
+    Takes the names of environment tasks, e.g.
+    `fab parallel_deploy:working_notes,working_notes_test,pool_size=2`. Other
+    keyword arguments are passed to `full_deploy`.
+    """
+    if not env_names:
+        abort(red('Name at least one environment to deploy to.'))
+
+    pool_size = int(kwargs.pop('pool_size', env.deploy_pool_size))
+    api_version = kwargs.get('api_version', 'HEAD')
+    renderer_version = kwargs.get('renderer_version', 'HEAD')
+
+    host_envs = get_host_envs(env_names)
+    hosts = host_envs.keys()
+
+    if not (utils.confirm_release('api', api_version, hosts) and
+            utils.confirm_release('renderer', renderer_version, hosts)):
+        return
+
+    with settings(parallel=True, pool_size=pool_size, deploy_confirmed=True):
+        results = execute(deploy_host, host_envs, hosts=hosts, **kwargs)
+
+    print ''
+    for host in hosts:
+        error = results.get(host)
+        if error is None:
+            print green('{}: deployed'.format(host))
+        else:
+            print red('{}: failed ({})'.format(host, error))
+
+    if any(error is not None for error in results.values()):
+        abort(red('Deploy failed on one or more hosts.'))
+
+
+def get_host_envs(env_names):
+    """
+    Map each host to the environment task that configures it.
+    """
+    host_envs = {}
+    saved_env = dict(env)
+
+    for env_name in env_names:
+        env_task = getattr(envs, env_name, None)
+        if not callable(env_task):
+            abort(red('No such environment: {}'.format(env_name)))
+
+        env_task()
+        for host in env.hosts:
+            host_envs[host] = env_task
+
+        env.clear()
+        env.update(saved_env)
+
+    return host_envs
+
+
+def deploy_host(host_envs, **kwargs):
+    """
+    Run `full_deploy` for the current host in its own environment.
+
+    Returns None on success, or a description of what went wrong, so that a
+    failing host does not stop the others.
+    """
+    host_envs[env.host]()
+    try:
+        full_deploy(**kwargs)
+    except SystemExit:
+        return 'aborted'
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
 
 
 @task
 def full_deploy_with_restart(api_version='HEAD', renderer_version='HEAD',
-                             markup_renderer_version=None):
-    full_deploy(api_version, renderer_version)
+                             markup_renderer_version=None, bench_budget=None):
+    full_deploy(api_version, renderer_version, markup_renderer_version,
+                bench_budget)
     restart_all_services()
+    finish_deploy()
 
+
+@task
+def pipelined_deploy(api_version='HEAD', renderer_version='HEAD',
+                     markup_renderer_version=None):
+    """
+    Deploy the site and restart, like `full_deploy_with_restart`, running
+    steps that do not depend on each other at the same time.
+
+    Each stage starts as soon as the stages it depends on have finished, so
+    that, for example, the API's requirements are installed while the
+    renderer is compiled. The time each stage took is printed at the end.
+    """
+    setup()
+
+    if not (utils.confirm_release('api', api_version, env.hosts) and
+            utils.confirm_release('renderer', renderer_version, env.hosts)):
+        return
+
+    # Ask for any sudo password now, rather than from every stage at once
+    sudo('true', quiet=True)
+
+    app_stages = [
+        ('api upload', lambda: api.upload_release(api_version), []),
+        ('api deps', api.install_deps, ['api upload']),
+        ('api settings', api.install_settings, ['api upload']),
+        ('api migrate', api.migrate_if_changed,
+         ['api deps', 'api settings']),
+        ('api static', api.collect_static_if_changed,
+         ['api deps', 'api settings']),
+        ('renderer upload', lambda: renderer.upload_release(renderer_version),
+         []),
+        ('renderer deps', renderer.install_deps, ['renderer upload']),
+        ('renderer compile', renderer.deploy, ['renderer deps']),
+        ('markup renderer',
+         lambda: markup_renderer.full_deploy(markup_renderer_version), []),
+        ('configs', install_configs, []),
+    ]
+
+    # Restarting also empties uWSGI's response cache
+    stages = app_stages + [
+        ('restart', restart_all_services,
+         [name for name, _, _ in app_stages]),
+    ]
+
+    with settings(deploy_confirmed=True):
+        utils.run_stages(stages)
+
+    finish_deploy()
+
+
+def finish_deploy():
+    """
+    Warm up a freshly restarted deploy, rolling it back if warmup fails, and
+    open the site.
+    """
     time.sleep(2)
+
+    if env.get('warmup_gate') and not warmup.warmup():
+        rollback()
+        abort(red('Rolled back {} after a failed warmup.'.format(env.host)))
+
     local('rmdir --ignore-fail-on-non-empty {TMP_DIR}'.format(**env))
     local('{} http://{}/'.format(
         'xdg-open' if 'linux' in sys.platform else 'open', env.host))
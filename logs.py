@@ -0,0 +1,297 @@
+"""
+Analysis of the nginx JSON access log.
+
+The log is streamed from the server and folded into running statistics one
+line at a time, so logs of any size can be analyzed in constant memory.
+"""
+
+import json
+import random
+import re
+from collections import defaultdict
+
+from fabric.api import *
+from fabric.colors import green, red
+
+from envs import ENVS
+import utils
+
+
+# Latencies kept per route for computing percentiles
+SAMPLE_SIZE = 10000
+
+# Path segments that identify a single object, replaced when grouping routes
+ID_SEGMENT = re.compile(r'/(\d+|[0-9a-f]{8}-[0-9a-f-]{27})(?=/|\.|$)')
+
+
+@task(default=True)
+def analyze(lines=100000, top=25):
+    """
+    Summarize latency and caching by route from the nginx JSON access log.
+
+    Reads the last `lines` lines of the log (or all of it, with `lines=all`)
+    and prints the `top` slowest routes by 95th percentile latency.
+    """
+    require('host', 'nginx_json_access_log', provided_by=ENVS)
+
+    if lines == 'all':
+        command = 'cat {}'.format(env.nginx_json_access_log)
+    else:
+        command = 'tail -n {} {}'.format(int(lines),
+                                         env.nginx_json_access_log)
+
+    routes = defaultdict(RouteStats)
+    stream_output(command, parse_entries(aggregate_routes(routes)))
+
+    print_routes(routes, int(top))
+
+
+@task
+def trace(request_id=None, lines=100000):
+    """
+    Print a timeline of everything logged for one request ID.
+
+    Without `request_id`, the slowest renderer request in the last `lines`
+    lines of the nginx JSON access log is traced. The timeline joins nginx's
+    log (the page request and any API requests the renderer made for it, if
+    the renderer forwards the request ID) with the API's uWSGI log.
+    """
+    require('host', 'nginx_json_access_log', provided_by=ENVS)
+
+    if request_id is None:
+        slowest = {}
+        stream_output(
+            'tail -n {} {}'.format(int(lines), env.nginx_json_access_log),
+            parse_entries(find_slowest(slowest, 'renderer')))
+        if not slowest:
+            abort(red('No renderer requests found.'))
+        request_id = slowest['entry']['request_id']
+
+    with hide('running', 'stdout'):
+        nginx_lines = sudo('grep -hF \'"request_id":"{}"\' {}'.format(
+            request_id, env.nginx_json_access_log), warn_only=True)
+        uwsgi_lines = sudo(
+            'journalctl --no-pager --output=cat --unit={}.api.service | '
+            'grep -F "request_id={}"'.format(env.host, request_id),
+            warn_only=True)
+
+    events = [nginx_event(json.loads(line))
+              for line in nginx_lines.splitlines() if line.strip()]
+    events += [uwsgi_event(line)
+               for line in uwsgi_lines.splitlines() if line.strip()]
+    events = sorted(event for event in events if event)
+
+    print green('\nRequest {}'.format(request_id))
+    if not events:
+        print 'Nothing logged.'
+        return
+
+    origin = events[0][0]
+    for start, duration, source, description in events:
+        print '{:>+8.0f}ms {:>8.0f}ms  {:<14} {}'.format(
+            (start - origin) * 1000, duration * 1000, source, description)
+
+
+def nginx_event(entry):
+    "A (start, duration, source, description) timeline event from nginx."
+    duration = parse_seconds(entry.get('request_time')) or 0
+    return (float(entry['msec']) - duration, duration,
+            'nginx/{}'.format(entry.get('backend', '-')),
+            '{} {} => {} (upstream {:.0f}ms, cache {})'.format(
+                entry.get('method'), entry.get('uri'), entry.get('status'),
+                (parse_seconds(entry.get('upstream_response_time')) or 0) *
+                1000, entry.get('cache') or '-'))
+
+
+UWSGI_LOG_LINE = re.compile(
+    r'(?P<method>\S+) (?P<uri>\S+) => (?P<status>\d+) .*'
+    r'start=(?P<start>\d+) msecs=(?P<msecs>\d+)')
+
+
+def uwsgi_event(line):
+    "A (start, duration, source, description) timeline event from uWSGI."
+    match = UWSGI_LOG_LINE.search(line)
+    if not match:
+        return None
+    return (int(match.group('start')) / 1000.0,
+            int(match.group('msecs')) / 1000.0,
+            'uwsgi',
+            '{method} {uri} => {status}'.format(**match.groupdict()))
+
+
+def stream_output(command, target):
+    """
+    Run a command on the server, sending each line of its output to the
+    coroutine `target` as it arrives, without keeping the output in memory.
+    """
+    with settings(hide('running'), output_prefix=False):
+        sudo(command, pty=False, combine_stderr=False,
+             stdout=LineStream(target), capture_buffer_size=4096)
+
+
+def coroutine(func):
+    "Create and start a generator that consumes values sent to it."
+    def start(*args, **kwargs):
+        generator = func(*args, **kwargs)
+        next(generator)
+        return generator
+    return start
+
+
+@coroutine
+def parse_entries(target):
+    "Parse lines of the JSON access log, sending each entry on to `target`."
+    while True:
+        line = (yield)
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        target.send(entry)
+
+
+@coroutine
+def aggregate_routes(routes):
+    "Add each log entry to the statistics for its route."
+    while True:
+        entry = (yield)
+        routes[get_route(entry)].add(entry)
+
+
+@coroutine
+def find_slowest(slowest, backend):
+    "Keep the slowest log entry handled by `backend` in `slowest['entry']`."
+    while True:
+        entry = (yield)
+        if entry.get('backend') != backend or not entry.get('request_id'):
+            continue
+        request_time = parse_seconds(entry.get('request_time')) or 0
+        if request_time > slowest.get('request_time', -1):
+            slowest['entry'] = entry
+            slowest['request_time'] = request_time
+
+
+def get_route(entry):
+    """
+    The (backend, method, path pattern) a log entry belongs to. Query strings
+    are dropped and numeric or UUID path segments replaced with `:id`.
+    """
+    path = entry.get('uri', '').split('?', 1)[0]
+    return (entry.get('backend', '-'), entry.get('method', '-'),
+            ID_SEGMENT.sub('/:id', path))
+
+
+def parse_seconds(value):
+    """
+    Parse a timing from the log. Upstream timings list one time for each
+    upstream tried, separated by commas or colons; these are added together.
+    """
+    total = None
+    for part in re.split(r'[,:]', value or ''):
+        try:
+            total = (total or 0) + float(part)
+        except ValueError:
+            pass
+    return total
+
+
+class RouteStats(object):
+    """
+    Running statistics for one route. Latencies are sampled, so percentiles
+    are estimates for routes with more than SAMPLE_SIZE requests.
+    """
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cacheable = 0
+        self.request_times = Reservoir()
+        self.upstream_times = Reservoir()
+
+    def add(self, entry):
+        self.requests += 1
+
+        if entry.get('status', '').startswith('5'):
+            self.errors += 1
+
+        cache = entry.get('cache')
+        if cache:
+            self.cacheable += 1
+            if cache in ('HIT', 'STALE', 'UPDATING', 'REVALIDATED'):
+                self.cache_hits += 1
+
+        self.request_times.add(parse_seconds(entry.get('request_time')))
+        self.upstream_times.add(parse_seconds(
+            entry.get('upstream_response_time')))
+
+    def percentile(self, pct, upstream=False):
+        samples = self.upstream_times if upstream else self.request_times
+        return utils.percentile(samples.values, pct)
+
+
+class Reservoir(object):
+    "A uniform random sample of at most SAMPLE_SIZE of the values added."
+    def __init__(self):
+        self.count = 0
+        self.values = []
+
+    def add(self, value):
+        if value is None:
+            return
+        self.count += 1
+        if len(self.values) < SAMPLE_SIZE:
+            self.values.append(value)
+        else:
+            i = random.randint(0, self.count - 1)
+            if i < SAMPLE_SIZE:
+                self.values[i] = value
+
+
+class LineStream(object):
+    "A file-like object that sends each complete line written to it on."
+    def __init__(self, target):
+        self.target = target
+        self.buffer = ''
+
+    def write(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self.target.send(line)
+
+    def flush(self):
+        pass
+
+
+def print_routes(routes, top):
+    if not routes:
+        print 'No log entries found.'
+        return
+
+    requests = sum(stats.requests for stats in routes.values())
+    cacheable = sum(stats.cacheable for stats in routes.values())
+    cache_hits = sum(stats.cache_hits for stats in routes.values())
+
+    print green('\n{} requests over {} routes'.format(requests, len(routes)))
+    if cacheable:
+        print 'Cache hit ratio: {:.1f}%'.format(
+            cache_hits * 100.0 / cacheable)
+
+    print ''
+    print '{:>8} {:>8} {:>8} {:>8} {:>9} {:>6} {:>6}  {}'.format(
+        'requests', 'p50 ms', 'p95 ms', 'p99 ms', 'upstr p95', 'hits',
+        'errors', 'route')
+
+    slowest = sorted(routes.items(),
+                     key=lambda item: -(item[1].percentile(95) or 0))
+    for (backend, method, path), stats in slowest[:top]:
+        print '{:>8} {:>8.0f} {:>8.0f} {:>8.0f} {:>9.0f} {:>6} {:>6}  {}'.format(
+            stats.requests,
+            (stats.percentile(50) or 0) * 1000,
+            (stats.percentile(95) or 0) * 1000,
+            (stats.percentile(99) or 0) * 1000,
+            (stats.percentile(95, upstream=True) or 0) * 1000,
+            '{:.0f}%'.format(stats.cache_hits * 100.0 / stats.cacheable)
+            if stats.cacheable else '-',
+            stats.errors,
+            '{:<8} {} {}'.format(backend, method, path))
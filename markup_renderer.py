@@ -5,12 +5,29 @@ from fabric.api import *
 from envs import ENVS
 
 
+PACKAGE = 'editorsnotes-markup-renderer'
+
+
 def install_renderer(version=None):
+    """
+    Install a version of the markup renderer (by default, the latest).
+
+    Nothing is done if that version is already installed.
+    """
     require('project_path', provided_by=ENVS)
     with cd(os.path.join(env.project_path, 'markup_renderer')):
         run('mkdir -p node_modules')
 
-        package = 'editorsnotes-markup-renderer'
+        package = PACKAGE
+        installed_version = get_installed_version()
+        wanted_version = version or run(
+            'npm view {} version'.format(package), quiet=True).strip()
+
+        if installed_version and installed_version == wanted_version:
+            print 'Markup renderer {} is already installed.'.format(
+                installed_version)
+            return
+
         run('npm uninstall {} --silent'.format(package))
 
         if (version):
@@ -19,6 +36,35 @@ def install_renderer(version=None):
         run('npm install {}'.format(package))
 
 
+def get_installed_version():
+    "Version of the installed markup renderer, or None if not installed."
+    with cd(os.path.join(env.project_path, 'markup_renderer')):
+        version = run(
+            '{} -p "require(\'./node_modules/{}/package.json\').version"'
+            .format(env.node_bin, PACKAGE), quiet=True)
+    return version.strip() if version.succeeded else None
+
+
+def installed_since_start():
+    """
+    Whether the markup renderer was installed after its service started (or
+    the service is not running), so that it must be restarted to run it.
+    """
+    require('host', 'project_path', provided_by=ENVS)
+    package_json = os.path.join(env.project_path, 'markup_renderer',
+                                'node_modules', PACKAGE, 'package.json')
+
+    # npm resets the modification times of the files it installs, so the
+    # time the package was written (its ctime) is compared instead
+    up_to_date = run(
+        'started=$(systemctl show -p ActiveEnterTimestamp --value '
+        '{}.markup-renderer.service) && [ -n "$started" ] && '
+        '[ "$(stat -c %Z {})" -le "$(date -d "$started" +%s)" ]'.format(
+            env.host, package_json),
+        quiet=True).succeeded
+    return not up_to_date
+
+
 @task
 def full_deploy(version='HEAD'):
     install_renderer()
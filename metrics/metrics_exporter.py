@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Expose uWSGI, nginx and renderer statistics for one site in the Prometheus
+text format, at http://127.0.0.1:<port>/metrics.
+
+Installed on the server and run by the {host}.metrics-exporter service.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import socket
+import subprocess
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.request import urlopen
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import urlopen
+
+
+CLOCK_TICKS = 100
+PAGE_SIZE = 4096
+
+
+def uwsgi_metrics(stats_socket):
+    "Worker, request and queue statistics from the uWSGI stats server."
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(5)
+    sock.connect(stats_socket)
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    sock.close()
+
+    stats = json.loads(data.decode('utf-8'))
+    workers = stats.get('workers', [])
+
+    statuses = {'idle': 0, 'busy': 0, 'cheap': 0}
+    for worker in workers:
+        status = worker.get('status', '')
+        if status.startswith('sig'):
+            status = 'busy'
+        statuses[status] = statuses.get(status, 0) + 1
+
+    samples = [('uwsgi_workers', 'gauge', {'status': status}, count)
+               for status, count in sorted(statuses.items())]
+    samples += [
+        ('uwsgi_listen_queue', 'gauge', None, stats.get('listen_queue', 0)),
+        ('uwsgi_listen_queue_errors', 'counter', None,
+         stats.get('listen_queue_errors', 0)),
+        ('uwsgi_requests_total', 'counter', None,
+         sum(w.get('requests', 0) for w in workers)),
+        ('uwsgi_exceptions_total', 'counter', None,
+         sum(w.get('exceptions', 0) for w in workers)),
+        ('uwsgi_harakiri_total', 'counter', None,
+         sum(w.get('harakiri_count', 0) for w in workers)),
+    ]
+    samples += [('uwsgi_worker_avg_response_seconds', 'gauge',
+                 {'worker': worker.get('id')}, worker.get('avg_rt', 0) / 1e6)
+                for worker in workers]
+    return samples
+
+
+def nginx_metrics(status_url):
+    "Connection and request counts from nginx's stub_status page."
+    text = urlopen(status_url, timeout=5).read().decode('utf-8').split()
+
+    # Active connections: N
+    # server accepts handled requests
+    #  A H R
+    # Reading: r Writing: w Waiting: i
+    active = int(text[2])
+    accepts, handled, requests = [int(n) for n in text[7:10]]
+    reading, writing, waiting = int(text[11]), int(text[13]), int(text[15])
+
+    return [
+        ('nginx_connections_active', 'gauge', None, active),
+        ('nginx_connections', 'gauge', {'state': 'reading'}, reading),
+        ('nginx_connections', 'gauge', {'state': 'writing'}, writing),
+        ('nginx_connections', 'gauge', {'state': 'waiting'}, waiting),
+        ('nginx_connections_accepted_total', 'counter', None, accepts),
+        ('nginx_connections_handled_total', 'counter', None, handled),
+        ('nginx_requests_total', 'counter', None, requests),
+    ]
+
+
+def renderer_metrics(host, ports):
+    "Memory and CPU use of each renderer instance's process."
+    samples = []
+    for port in ports:
+        unit = '{}.renderer@{}.service'.format(host, port)
+        pid = subprocess.check_output(
+            ['systemctl', 'show', '--property=MainPID', '--value', unit]
+        ).decode('utf-8').strip()
+
+        labels = {'port': port}
+        if not pid or pid == '0':
+            samples.append(('renderer_up', 'gauge', labels, 0))
+            continue
+
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # Fields after the command name, which may contain spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        utime, stime, rss = int(fields[11]), int(fields[12]), int(fields[21])
+
+        samples += [
+            ('renderer_up', 'gauge', labels, 1),
+            ('renderer_resident_memory_bytes', 'gauge', labels,
+             rss * PAGE_SIZE),
+            ('renderer_cpu_seconds_total', 'counter', labels,
+             float(utime + stime) / CLOCK_TICKS),
+        ]
+    return samples
+
+
+def collect(options):
+    sources = [
+        ('uwsgi', lambda: uwsgi_metrics(options.uwsgi_stats)),
+        ('nginx', lambda: nginx_metrics(options.nginx_status)),
+        ('renderer', lambda: renderer_metrics(options.host,
+                                              options.renderer_ports)),
+    ]
+    samples = []
+    for name, source in sources:
+        try:
+            source_samples = source()
+        except Exception:
+            samples.append(('exporter_source_up', 'gauge', {'source': name},
+                            0))
+        else:
+            samples.append(('exporter_source_up', 'gauge', {'source': name},
+                            1))
+            samples += source_samples
+    return format_samples(samples)
+
+
+def format_samples(samples):
+    """
+    Format (name, type, labels, value) samples in the Prometheus text format.
+
+    Every sample of a metric family must directly follow its TYPE line, so
+    samples are grouped by family, in the order families first appear.
+    """
+    families = []
+    family_lines = {}
+    for name, metric_type, labels, value in samples:
+        if name not in family_lines:
+            families.append(name)
+            family_lines[name] = ['# TYPE {} {}'.format(name, metric_type)]
+        label_text = ','.join('{}="{}"'.format(key, labels[key])
+                              for key in sorted(labels or {}))
+        family_lines[name].append('{}{} {}'.format(
+            name, '{' + label_text + '}' if label_text else '', value))
+
+    return ''.join('\n'.join(family_lines[name]) + '\n'
+                   for name in families)
+
+
+def make_handler(options):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = collect(options).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--host', required=True)
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--uwsgi-stats', required=True)
+    parser.add_argument('--nginx-status', required=True)
+    parser.add_argument('--renderer-ports', required=True,
+                        type=lambda ports: ports.split(','))
+    options = parser.parse_args()
+
+    server = HTTPServer(('127.0.0.1', options.port), make_handler(options))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,145 @@
 #!/usr/bin/env python
 
+import re
 import sys
 
-template_head = """# vim set filetype=conf
+cache_http_template = """
+# Response caches for anonymous reads
+proxy_cache_path {CACHE_DIR}/{HOST}-renderer levels=1:2 use_temp_path=off
+                 keys_zone={HOST}_renderer:{CACHE_KEYS_ZONE_SIZE}
+                 max_size={CACHE_MAX_SIZE} inactive={CACHE_INACTIVE};
+
+uwsgi_cache_path {CACHE_DIR}/{HOST}-api levels=1:2 use_temp_path=off
+                 keys_zone={HOST}_api:{CACHE_KEYS_ZONE_SIZE}
+                 max_size={CACHE_MAX_SIZE} inactive={CACHE_INACTIVE};
+
+# Never serve or store cached responses for logged-in users
+map $en_{HOST_ID}_auth $en_{HOST_ID}_cache_bypass {{
+    default 1;
+    anonymous 0;
+}}
+"""
+
+upstream_template = """
+# Backends. Connections to the renderer are kept open and reused between
+# requests; the uWSGI protocol closes its connection after every response, but
+# the unix socket is cheap to connect to.
+upstream en_{HOST_ID}_renderer {{
+    least_conn;
+{RENDERER_SERVERS}
+    keepalive {RENDERER_KEEPALIVE};
+}}
+
+upstream en_{HOST_ID}_api {{
+    server unix:{UWSGI_SOCKET_LOCATION};
+}}
+"""
+
+routing_template = """
+# Classify each request once, for routing and caching under `location /`.
+# A type suffix picks the backend; otherwise requests that accept HTML go to
+# the renderer and the rest to the API.
+map $uri $en_{HOST_ID}_suffix_backend {{
+    default "";
+    ~*\.(json|jsonld|jsonld-browse|ttl|ttl-browse)$ api;
+    ~*\.html$ renderer;
+}}
+
+# Common Accept headers are grouped into classes; any other header is its
+# own class
+map $http_accept $en_{HOST_ID}_accept_class {{
+    default $http_accept;
+    "" any;
+    "*/*" any;
+    ~*html html;
+    application/json json;
+    application/ld+json jsonld;
+    text/turtle turtle;
+}}
+
+map $en_{HOST_ID}_suffix_backend:$en_{HOST_ID}_accept_class $en_{HOST_ID}_backend {{
+    default api;
+    ~^renderer: renderer;
+    :html renderer;
+}}
+
+# Responses to URLs without a type suffix depend on the Accept header
+map $en_{HOST_ID}_suffix_backend $en_{HOST_ID}_vary {{
+    default "";
+    "" Accept;
+}}
+
+# Whether the request carries a Django session or credentials
+map $cookie_sessionid$http_authorization $en_{HOST_ID}_auth {{
+    default user;
+    "" anonymous;
+}}
+
+# Responses are cached separately for each backend and Accept class
+map $en_{HOST_ID}_backend $en_{HOST_ID}_cache_key {{
+    default $scheme$host$request_uri|$en_{HOST_ID}_backend|$en_{HOST_ID}_accept_class|$en_{HOST_ID}_auth;
+}}
+"""
+
+log_template = """
+# ID for tracing a request through nginx, the renderer and the API. IDs sent
+# by clients (including the renderer, for its API requests) are kept.
+map $http_x_request_id $en_{HOST_ID}_request_id {{
+    default $http_x_request_id;
+    "" $request_id;
+}}
+
+# Access log with timings, for `fab logs.analyze` and `fab logs.trace`
+log_format en_{HOST_ID}_json escape=json '{{'
+    '"time":"$time_iso8601",'
+    '"msec":"$msec",'
+    '"request_id":"$en_{HOST_ID}_request_id",'
+    '"method":"$request_method",'
+    '"uri":"$request_uri",'
+    '"status":"$status",'
+    '"bytes":"$body_bytes_sent",'
+    '"accept":"$http_accept",'
+    '"backend":"$en_backend",'
+    '"request_time":"$request_time",'
+    '"upstream_addr":"$upstream_addr",'
+    '"upstream_connect_time":"$upstream_connect_time",'
+    '"upstream_response_time":"$upstream_response_time",'
+    '"cache":"$upstream_cache_status"'
+'}}';
+"""
+
+internal_template = """
+# Loopback-only server for the renderer's API requests and local tools. API
+# requests go straight to uWSGI, as if they had been made to {HOST}, without
+# the redirect to HTTPS or a TLS handshake.
+server {{
+    listen 127.0.0.1:{NGINX_INTERNAL_PORT};
+    server_name {HOST}.internal;
+
+    set $en_backend api;
+    access_log {JSON_ACCESS_LOG} en_{HOST_ID}_json;
+    keepalive_requests 10000;
+
+    location / {{
+        include uwsgi_params;
+        uwsgi_param HTTP_X_REQUEST_ID $en_{HOST_ID}_request_id;
+        uwsgi_param HTTP_HOST {HOST};
+        uwsgi_param SERVER_NAME {HOST};{INTERNAL_HTTPS}
+        uwsgi_pass en_{HOST_ID}_api;
+    }}
+{INTERNAL_LOCATIONS}}}
+"""
+
+stub_status_template = """
+    # Connection and request counts, read by the metrics exporter
+    location = /nginx_status {{
+        stub_status;
+        access_log off;
+    }}
+"""
 
+template_head = """# vim set filetype=conf
+{UPSTREAMS}{ROUTING}{CACHE_HTTP}{LOG_FORMAT}{INTERNAL_SERVER}
 server {{
     listen 80;
     server_name {HOST};
@@ -14,24 +150,57 @@ ssl_template_head = """
 }}
 
 server {{
-    listen 443 ssl;
+    listen 443 ssl{HTTP2};
     server_name {HOST};
 
     include {SSL_CONF_FILE};
-
+{SSL_TUNING}
     if ($host != {HOST}) {{
         return 444;
     }}
 """
 
+ssl_session_cache_template = """
+    # Let returning clients resume their TLS session instead of repeating the
+    # full handshake
+    ssl_session_cache shared:en_{HOST_ID}_ssl:{SSL_SESSION_CACHE};
+    ssl_session_timeout {SSL_SESSION_TIMEOUT};
+"""
+
+ssl_stapling_template = """
+    # Send the certificate's OCSP response with the handshake, so that
+    # clients do not have to fetch it from the CA (needs `resolver` and
+    # `ssl_trusted_certificate` to be set in {SSL_CONF_FILE})
+    ssl_stapling on;
+    ssl_stapling_verify on;
+"""
+
+ssl_buffer_size_template = """
+    # Smaller TLS records, so that browsers can start parsing a page before
+    # the whole of a large response has arrived
+    ssl_buffer_size {SSL_BUFFER_SIZE};
+"""
+
 template = """
     #################
     # Configuration #
     #################
 
     set $project_dir {PROJECT_PATH};
-    set $en_api_uwsgi unix:{UWSGI_SOCKET_LOCATION};
-    set $en_renderer_http http://127.0.0.1:{RENDERER_PORT};
+
+    # Which backend handled the request, for the access log (overridden in
+    # each proxied location)
+    set $en_backend static;
+    access_log {ACCESS_LOG} combined;
+    access_log {JSON_ACCESS_LOG} en_{HOST_ID}_json;
+
+    # Serve files from disk with precompressed copies where they exist
+    sendfile on;
+    tcp_nopush on;
+    gzip_static on;{BROTLI_STATIC}
+    open_file_cache max=10000 inactive=5m;
+    open_file_cache_valid 1m;
+    open_file_cache_errors on;
 
 
     ################
@@ -39,60 +208,83 @@ template = """
     ################
 
     location / {{
+        set $en_backend $en_{HOST_ID}_backend;
+        add_header X-Request-ID $en_{HOST_ID}_request_id always;
+        add_header Vary $en_{HOST_ID}_vary;{CACHE_HEADER}
+
+        # Hand HTML to editorsnotes-renderer
+        error_page 418 = @renderer;
+        if ($en_{HOST_ID}_backend = renderer) {{
+            return 418;
+        }}
+
+        # Else, pass to editorsnotes-api
+        include uwsgi_params;
+        uwsgi_param HTTP_X_REQUEST_ID $en_{HOST_ID}_request_id;
+        uwsgi_pass en_{HOST_ID}_api;
+{API_CACHE_DIRECTIVES}    }}
+
+    location @renderer {{
+        set $en_backend renderer;
+        add_header X-Request-ID $en_{HOST_ID}_request_id always;
+        add_header Vary $en_{HOST_ID}_vary;{CACHE_HEADER}
+
+        # Pages requested with an HTML suffix are rendered without it
+        rewrite ^(/.+)\.html$ $1/ break;
+
         # Rewrite `Host` to this server name
         proxy_pass_request_headers on;
         proxy_set_header Host $http_host;
 
-        # Pass type-specific suffixes (except HTML) to editorsnotes-api
-        location ~* \.(json|jsonld|jsonld-browse|ttl|ttl-browse)$ {{
-            include uwsgi_params;
-            uwsgi_pass $en_api_uwsgi;
-        }}
-
-        # If suffix is HTML, pass to editorsnotes-renderer
-        location ~* \.html$ {{
-            rewrite ^(/.+)\.html$ $1/ break;
-            proxy_pass $en_renderer_http;
-            break;
-        }}
+        # Reuse upstream connections to the renderer
+        proxy_http_version 1.1;
+        proxy_set_header Connection "";
 
-        # If request accepts HTML, pass to editorsnotes-renderer
-        if ($http_accept ~* "html") {{
-            proxy_pass $en_renderer_http;
-            break;
-        }}
+        # Tag the request with its ID
+        proxy_set_header X-Request-ID $en_{HOST_ID}_request_id;
 
-        # Else, pass to editorsnotes-api
-        include uwsgi_params;
-        uwsgi_pass $en_api_uwsgi;
-    }}
+        proxy_pass http://en_{HOST_ID}_renderer;
+{RENDERER_CACHE_DIRECTIVES}    }}
 
     # Proxy to Django for authentication, regardless of media type
     location /auth/ {{
+        set $en_backend api;
         proxy_pass_request_headers on;
         proxy_set_header Host $http_host;
         include uwsgi_params;
-        uwsgi_pass $en_api_uwsgi;
+        uwsgi_param HTTP_X_REQUEST_ID $en_{HOST_ID}_request_id;
+        uwsgi_pass en_{HOST_ID}_api;
     }}
 
     # Static files
     location /static/ {{
         root $project_dir/renderer/releases/current/;
+        expires {STATIC_EXPIRES};
+
+        # Files with a content hash in their name never change. (`expires` is
+        # turned off so that this is the only Cache-Control header.)
+        location ~* "\.[0-9a-f]{{8,}}\.[a-z0-9]+$" {{
+            expires off;
+            add_header Cache-Control "public, max-age=31536000, immutable";
+        }}
     }}
 
     # Static file for authentication page
     location /static/admin_compiled.css {{
         root $project_dir;
+        expires {STATIC_EXPIRES};
     }}
 
     # Static files for Django REST framework
     location /static/rest_framework/ {{
         root $project_dir;
+        expires {STATIC_EXPIRES};
     }}
 
     # Image uploads
     location /media/ {{
         alias $project_dir/uploads/;
+        expires {STATIC_EXPIRES};
     }}
 
     # Let's Encrypt challenges
@@ -103,19 +295,117 @@ template = """
 }}
 """
 
+renderer_cache_template = """
+        # Microcache anonymous renderer responses in the same way
+        proxy_cache {HOST}_renderer;
+        proxy_cache_key $en_{HOST_ID}_cache_key;
+        proxy_cache_valid 200 301 302 {CACHE_TTL};
+        proxy_cache_lock on;
+        proxy_cache_use_stale error timeout updating http_500 http_502 http_503 http_504;
+        proxy_cache_background_update on;
+        proxy_cache_bypass $en_{HOST_ID}_cache_bypass;
+        proxy_no_cache $en_{HOST_ID}_cache_bypass;
+"""
+
+api_cache_template = """
+        # Microcache anonymous GET and HEAD requests for a short time,
+        # collapsing concurrent misses into a single upstream request and
+        # serving stale copies while they are refreshed in the background
+        uwsgi_cache {HOST}_api;
+        uwsgi_cache_key $en_{HOST_ID}_cache_key;
+        uwsgi_cache_valid 200 301 302 {CACHE_TTL};
+        uwsgi_cache_lock on;
+        uwsgi_cache_use_stale error timeout updating http_500 http_503;
+        uwsgi_cache_background_update on;
+        uwsgi_cache_bypass $en_{HOST_ID}_cache_bypass;
+        uwsgi_no_cache $en_{HOST_ID}_cache_bypass;
+"""
+
 if __name__ == '__main__':
     template_dict = {
         'HOST': sys.argv[1],
         'PROJECT_PATH': sys.argv[2],
         'UWSGI_SOCKET_LOCATION': sys.argv[3],
-        'RENDERER_PORT': sys.argv[4],
+        'RENDERER_PORTS': sys.argv[4].split(','),
+        'CACHE': sys.argv[5] == 'True',
+        'CACHE_DIR': sys.argv[6],
+        'CACHE_KEYS_ZONE_SIZE': sys.argv[7],
+        'CACHE_MAX_SIZE': sys.argv[8],
+        'CACHE_INACTIVE': sys.argv[9],
+        'CACHE_TTL': sys.argv[10],
+        'RENDERER_KEEPALIVE': sys.argv[11],
+        'STATIC_EXPIRES': sys.argv[12],
+        'BROTLI_STATIC': sys.argv[13] == 'True',
+        'ACCESS_LOG': sys.argv[14],
+        'JSON_ACCESS_LOG': sys.argv[15],
+        'METRICS': sys.argv[16] == 'True',
+        'NGINX_INTERNAL_PORT': sys.argv[17],
+        'HTTP2': sys.argv[18] == 'True',
+        'SSL_SESSION_CACHE': sys.argv[19],
+        'SSL_SESSION_TIMEOUT': sys.argv[20],
+        'SSL_SESSION_TICKETS': sys.argv[21],
+        'SSL_STAPLING': sys.argv[22] == 'True',
+        'SSL_BUFFER_SIZE': sys.argv[23],
     }
+    template_dict['HOST_ID'] = re.sub(r'\W', '_', template_dict['HOST'])
+
+    template_dict['RENDERER_SERVERS'] = '\n'.join(
+        '    server 127.0.0.1:{};'.format(port)
+        for port in template_dict['RENDERER_PORTS'])
+    template_dict['UPSTREAMS'] = upstream_template.format(**template_dict)
+    template_dict['ROUTING'] = routing_template.format(**template_dict)
+    template_dict['LOG_FORMAT'] = log_template.format(**template_dict)
+
+    # The site is served over HTTPS if an SSL configuration file is given
+    template_dict['INTERNAL_HTTPS'] = (
+        '\n        uwsgi_param HTTPS on;' if len(sys.argv) > 24 else '')
+    template_dict['INTERNAL_LOCATIONS'] = ''
+    if template_dict['METRICS']:
+        template_dict['INTERNAL_LOCATIONS'] = stub_status_template.format(
+            **template_dict)
+    template_dict['INTERNAL_SERVER'] = internal_template.format(
+        **template_dict)
+
+    # `brotli_static` needs the third-party ngx_brotli module
+    template_dict['BROTLI_STATIC'] = (
+        '\n    brotli_static on;' if template_dict['BROTLI_STATIC'] else '')
+
+    template_dict['CACHE_HTTP'] = ''
+    template_dict['CACHE_HEADER'] = ''
+    template_dict['RENDERER_CACHE_DIRECTIVES'] = ''
+    template_dict['API_CACHE_DIRECTIVES'] = ''
+    if template_dict['CACHE']:
+        template_dict['CACHE_HTTP'] = cache_http_template.format(
+            **template_dict)
+        template_dict['CACHE_HEADER'] = (
+            '\n        add_header X-Cache-Status $upstream_cache_status;')
+        template_dict['RENDERER_CACHE_DIRECTIVES'] = (
+            renderer_cache_template.format(**template_dict))
+        template_dict['API_CACHE_DIRECTIVES'] = api_cache_template.format(
+            **template_dict)
+
     template_start = template_head.format(**template_dict)
 
     try:
-        template_dict['SSL_CONF_FILE'] = sys.argv[5]
-        template_start += ssl_template_head.format(**template_dict)
+        template_dict['SSL_CONF_FILE'] = sys.argv[24]
     except IndexError:
         pass
+    else:
+        # TLS settings left as None are not set here, so they can be set in
+        # SSL_CONF_FILE instead (nginx refuses duplicate directives)
+        template_dict['HTTP2'] = ' http2' if template_dict['HTTP2'] else ''
+        ssl_tuning = ''
+        if template_dict['SSL_SESSION_CACHE'] != 'None':
+            ssl_tuning += ssl_session_cache_template.format(**template_dict)
+        if template_dict['SSL_SESSION_TICKETS'] != 'None':
+            ssl_tuning += '\n    ssl_session_tickets {};\n'.format(
+                'on' if template_dict['SSL_SESSION_TICKETS'] == 'True'
+                else 'off')
+        if template_dict['SSL_STAPLING']:
+            ssl_tuning += ssl_stapling_template.format(**template_dict)
+        if template_dict['SSL_BUFFER_SIZE'] != 'None':
+            ssl_tuning += ssl_buffer_size_template.format(**template_dict)
+        template_dict['SSL_TUNING'] = ssl_tuning
+        template_start += ssl_template_head.format(**template_dict)
 
     print template_start + template.format(**template_dict)
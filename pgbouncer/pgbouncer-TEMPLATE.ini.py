@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import sys
+
+template = """[databases]
+; Every database the API asks for, on the same PostgreSQL server
+* = host={POSTGRES_HOST} port={POSTGRES_PORT}
+
+[pgbouncer]
+listen_addr = 127.0.0.1
+listen_port = {PORT}
+unix_socket_dir =
+
+auth_type = {AUTH_TYPE}
+auth_file = {AUTH_FILE}
+
+; Server connections are shared between clients after every transaction, so
+; the number of uWSGI workers does not decide the number of PostgreSQL
+; backends
+pool_mode = transaction
+default_pool_size = {POOL_SIZE}
+reserve_pool_size = {RESERVE_POOL_SIZE}
+max_client_conn = {MAX_CLIENT_CONN}
+
+; Log to the journal, through stderr
+syslog = 0
+logfile =
+"""
+
+if __name__ == '__main__':
+    print template.format(**{
+        'HOST': sys.argv[1],
+        'PORT': sys.argv[2],
+        'POSTGRES_HOST': sys.argv[3],
+        'POSTGRES_PORT': sys.argv[4],
+        'AUTH_TYPE': sys.argv[5],
+        'AUTH_FILE': sys.argv[6],
+        'POOL_SIZE': sys.argv[7],
+        'RESERVE_POOL_SIZE': sys.argv[8],
+        'MAX_CLIENT_CONN': sys.argv[9],
+    })
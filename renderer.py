@@ -1,6 +1,7 @@
 import os
 
 from fabric.api import *
+from fabric.contrib.files import exists
 
 import utils
 from envs import ENVS
@@ -14,9 +15,43 @@ def upload_release(version='HEAD'):
 
 @task
 def install_deps():
+    """
+    Install node modules for the current release.
+
+    Installed modules are cached in `renderer/node_modules_cache`, keyed by a
+    hash of the release's package and lock files and the node version. A
+    release whose hash is already cached gets a hard-linked copy of the cached
+    modules instead of running npm.
+    """
     require('hosts', 'project_path', provided_by=ENVS)
+    renderer_dir = os.path.join(env.project_path, 'renderer')
+    cached_modules = os.path.join(
+        renderer_dir, 'node_modules_cache', get_package_hash())
+
+    with cd(os.path.join(renderer_dir, 'releases', 'current')):
+        if exists(cached_modules):
+            run('rm -rf node_modules')
+            run('cp -al {} node_modules'.format(cached_modules))
+            return
+
+        npm_opts = '--prefer-offline --cache {}'.format(
+            os.path.join(renderer_dir, 'npm_cache'))
+        if exists('package-lock.json') or exists('npm-shrinkwrap.json'):
+            run('npm ci {}'.format(npm_opts))
+        else:
+            run('npm install {}'.format(npm_opts))
+
+        run('mkdir -p {}'.format(os.path.dirname(cached_modules)))
+        run('cp -al node_modules {0}.tmp && mv {0}.tmp {0}'.format(
+            cached_modules))
+
+
+def get_package_hash():
+    "Hash of the current release's npm package files and node version"
     with cd(os.path.join(env.project_path, 'renderer', 'releases', 'current')):
-        run('npm install')
+        return run('(cat package.json package-lock.json npm-shrinkwrap.json '
+                   '2> /dev/null; {node_bin} --version) | '
+                   'sha256sum | cut -c 1-16'.format(**env)).strip()
 
 
 @task
@@ -26,9 +61,24 @@ def full_deploy(version='HEAD'):
     deploy()
 
 
+# Every file in a release, except its installed modules, for
+# `utils.unless_unchanged`
+COMPILE_INPUTS = (". \\( -path ./node_modules -o -path ./.fingerprints \\) "
+                  "-prune -o -type f -print0")
+
+
 @task
 def deploy():
-    compile_application()
+    """
+    Compile the current release, unless none of its files (or the version of
+    node) have changed since the previous release, in which case the compiled
+    files are hard-linked from the previous release.
+    """
+    require('hosts', 'project_path', provided_by=ENVS)
+    utils.unless_unchanged('renderer', 'compile', COMPILE_INPUTS,
+                           compile_application,
+                           extra='{node_bin} --version'.format(**env),
+                           outputs=True)
 
 
 @task
@@ -36,3 +86,5 @@ def compile_application():
     require('hosts', 'project_path', provided_by=ENVS)
     with cd(os.path.join(env.project_path, 'renderer', 'releases', 'current')):
         run('make')
+    utils.precompress_static(os.path.join(
+        env.project_path, 'renderer', 'releases', 'current', 'static'))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import sys
+
+template = """[Unit]
+Description=Editors' Notes metrics exporter for {HOST}
+BindsTo={HOST}.target
+
+[Service]
+User={USER}
+Group={GROUP}
+
+ExecStart={PYTHON} {PROJECT_PATH}/conf/metrics_exporter.py\
+ --host={HOST}\
+ --port={METRICS_PORT}\
+ --uwsgi-stats={UWSGI_STATS_SOCKET}\
+ --nginx-status=http://127.0.0.1:{NGINX_INTERNAL_PORT}/nginx_status\
+ --renderer-ports={RENDERER_PORTS}
+
+Restart=always
+
+StandardOutput=syslog
+StandardError=syslog
+SyslogIdentifier={HOST}.metrics-exporter
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+if __name__ == '__main__':
+    print template.format(**{
+        'HOST': sys.argv[1],
+        'PYTHON': sys.argv[2],
+        'PROJECT_PATH': sys.argv[3],
+        'METRICS_PORT': sys.argv[4],
+        'UWSGI_STATS_SOCKET': sys.argv[5],
+        'NGINX_INTERNAL_PORT': sys.argv[6],
+        'RENDERER_PORTS': sys.argv[7],
+        'USER': sys.argv[8],
+        'GROUP': sys.argv[9],
+    })
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+import sys
+
+template = """[Unit]
+Description=Editors' Notes PgBouncer connection pool for {HOST}
+BindsTo={HOST}.target
+After=postgresql.service
+
+[Service]
+User={USER}
+Group={GROUP}
+
+ExecStart={PGBOUNCER_BIN} {PGBOUNCER_CONF_FILE}
+ExecReload=/bin/kill -HUP $MAINPID
+
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+if __name__ == '__main__':
+    print template.format(**{
+        'HOST': sys.argv[1],
+        'PGBOUNCER_BIN': sys.argv[2],
+        'PGBOUNCER_CONF_FILE': sys.argv[3],
+        'USER': sys.argv[4],
+        'GROUP': sys.argv[5],
+    })
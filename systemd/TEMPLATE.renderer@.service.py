@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+
+import sys
+
+# Instanced unit: the instance name is the port the renderer listens on, e.g.
+# {HOST}.renderer@15023.service
+template = """[Unit]
+Description=Editors' Notes renderer node server for {HOST} on port %i
+BindsTo={HOST}.target
+
+[Service]
+ExecStart={NODE_BIN} {PROJECT_PATH}/renderer/releases/current/bin/serve.js
+Restart=always
+
+StandardOutput=syslog
+StandardError=syslog
+SyslogIdentifier={HOST}.renderer@%i
+
+# API requests go to nginx's loopback-only server, which passes them straight
+# to uWSGI. They should forward the page request's
+# EDITORSNOTES_REQUEST_ID_HEADER, so they can be traced back to it.
+Environment=\
+ "EDITORSNOTES_API_URL=http://127.0.0.1:{NGINX_INTERNAL_PORT}"\
+ "EDITORSNOTES_RENDERER_PORT=%i"\
+ "EDITORSNOTES_REQUEST_ID_HEADER=X-Request-ID"\
+ "NODE_ENV=production"
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+if __name__ == '__main__':
+    print template.format(**{
+        'HOST': sys.argv[1],
+        'NODE_BIN': sys.argv[2],
+        'PROJECT_PATH': sys.argv[3],
+        'NGINX_INTERNAL_PORT': sys.argv[4],
+    })
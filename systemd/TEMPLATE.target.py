@@ -5,8 +5,10 @@ import sys
 template = """[Unit]
 Description={HOST} site
 Requires={HOST}.api.service\
- {HOST}.renderer.service\
- {HOST}.markup-renderer.service
+{RENDERER_SERVICES}\
+ {HOST}.markup-renderer.service\
+{METRICS_SERVICE}\
+{PGBOUNCER_SERVICE}
 
 Requires=nginx.service
 Requires=postgresql.service
@@ -16,6 +18,20 @@ RequiredBy=multi-user.target
 """
 
 if __name__ == '__main__':
-    print template.format(**{
+    template_dict = {
         'HOST': sys.argv[1],
-    })
+        'RENDERER_PORTS': sys.argv[2].split(','),
+        'METRICS': sys.argv[3] == 'True',
+        'PGBOUNCER': sys.argv[4] == 'True',
+    }
+    template_dict['RENDERER_SERVICES'] = ''.join(
+        ' {}.renderer@{}.service'.format(template_dict['HOST'], port)
+        for port in template_dict['RENDERER_PORTS'])
+    template_dict['METRICS_SERVICE'] = (
+        ' {}.metrics-exporter.service'.format(template_dict['HOST'])
+        if template_dict['METRICS'] else '')
+    template_dict['PGBOUNCER_SERVICE'] = (
+        ' {}.pgbouncer.service'.format(template_dict['HOST'])
+        if template_dict['PGBOUNCER'] else '')
+
+    print template.format(**template_dict)
@@ -1,6 +1,22 @@
+import errno
+import hashlib
+import math
+import multiprocessing
+import os
+import pipes
+import Queue
+import tarfile
+import tempfile
+import time
+from StringIO import StringIO
+
 from fabric.api import *
 from fabric.colors import red, green
 from fabric.contrib.console import confirm
+from fabric.contrib.files import exists
+from fabric.contrib.project import rsync_project
+from fabric.network import disconnect_all, normalize_to_string
+from fabric.state import connections
 
 from envs import ENVS
 
@@ -25,9 +41,133 @@ def symlink_current_release(project):
             run('ln -s {release} releases/current'.format(**env))
 
 
+def rollback_release(project):
+    """
+    Swap the current and previous releases of a project.
+
+    Database migrations run by the rolled-back release are not reversed.
+    """
+    confirm_subproject(project)
+
+    if not has_previous_release(project):
+        abort(red('There is no previous release of {} on {} to roll back '
+                  'to.'.format(project, env.host)))
+
+    with cd(env.project_path):
+        with cd(project):
+            run('mv releases/current releases/rollback; '
+                'mv releases/previous releases/current; '
+                'mv releases/rollback releases/previous')
+
+
+def has_previous_release(project):
+    """
+    Whether a project has a release to roll back to. Until its second
+    release, `previous` points at the placeholder `none`.
+    """
+    require('project_path', provided_by=ENVS)
+    with cd(os.path.join(env.project_path, project, 'releases')):
+        return run('[ -d previous ] && [ "$(readlink previous)" != none ]',
+                   quiet=True).succeeded
+
+
+def unless_unchanged(project, step, inputs, func, extra=None,
+                     outputs=False, shared_fingerprint=None):
+    """
+    Run `func`, a deploy step for the current release of a project, unless
+    its inputs are the same as in the previous release.
+
+    `inputs` are arguments to `find`, run in the release directory, that
+    print (null-separated) the files the step depends on. Their names and
+    contents, and the output of the shell command `extra`, are hashed into a
+    fingerprint that is kept in the release's `.fingerprints` directory once
+    the step has succeeded.
+
+    With `outputs`, the files the step creates or changes in the release are
+    recorded as well, and when the step is skipped they are hard-linked from
+    the previous release instead.
+
+    A step whose results are kept outside the release (in the database, or in
+    a directory every release shares) passes `shared_fingerprint` instead: a
+    file, kept with those results, holding the fingerprint of the step's last
+    successful run. The step is skipped only if its inputs match that run's,
+    whichever release it was for, so that a rollback is never mistaken for
+    results being up to date.
+    """
+    require('project_path', provided_by=ENVS)
+    releases = os.path.join(env.project_path, project, 'releases')
+    current = os.path.join(releases, 'current')
+    previous = os.path.join(releases, 'previous')
+    last_fingerprint_file = shared_fingerprint or os.path.join(
+        previous, '.fingerprints', step)
+
+    with cd(current):
+        fingerprint = run(
+            '(find {} | sort -z | xargs -0 -r sha256sum; {}) | '
+            'sha256sum | cut -c 1-16'.format(inputs, extra or 'true'),
+            quiet=True).strip()
+        run('mkdir -p .fingerprints')
+
+    last_fingerprint = run(
+        'cat {} 2> /dev/null'.format(last_fingerprint_file),
+        quiet=True).strip()
+
+    if env.get('deploy_skip_unchanged') and fingerprint == last_fingerprint:
+        if outputs:
+            # Nothing to link if the same release is being redeployed
+            with cd(previous):
+                run('[ "$(pwd -P)" = "$(cd {0} && pwd -P)" ] || '
+                    '(xargs -a .fingerprints/{1}.outputs -d "\\n" -r '
+                    'cp -alf --parents -t {0} && '
+                    'cp .fingerprints/{1}.outputs {0}/.fingerprints/)'.format(
+                        current, step))
+        with cd(current):
+            run('echo {} > .fingerprints/{}'.format(fingerprint, step))
+        print green('Skipped {} {}: no changes since {}'.format(
+            project, step, 'its last run' if shared_fingerprint
+            else 'the previous release'))
+        return
+
+    with cd(current):
+        run('rm -f .fingerprints/{0} && touch .fingerprints/{0}.started'
+            .format(step))
+    if shared_fingerprint:
+        # Until the step succeeds, its shared results match no release
+        run('rm -f {}'.format(shared_fingerprint))
+
+    func()
+
+    with cd(current):
+        if outputs:
+            run('find . \\( -path ./node_modules -o -path ./.fingerprints \\) '
+                '-prune -o -type f -newer .fingerprints/{0}.started -print '
+                '> .fingerprints/{0}.outputs'.format(step))
+        run('echo {0} > .fingerprints/{1} && rm .fingerprints/{1}.started'
+            .format(fingerprint, step))
+    if shared_fingerprint:
+        run('echo {} > {}'.format(fingerprint, shared_fingerprint))
+
+
 def upload_release(project, version='HEAD'):
     require('hosts', 'project_path', provided_by=ENVS)
 
+    if not confirm_release(project, version, env.hosts):
+        return
+
+    local('mkdir -p {}'.format(env.TMP_DIR))
+    if env.get('upload_method') == 'rsync':
+        upload_rsync_from_git(project, env.git[project], version)
+    else:
+        upload_tar_from_git(project, env.git[project], version)
+
+
+def confirm_release(project, version, hosts):
+    """
+    Ask whether to deploy a version of a project to some hosts.
+
+    Skipped (and treated as confirmed) when `deploy_confirmed` is set, as it is
+    for parallel deploys, which confirm every release up front.
+    """
     confirm_subproject(project)
 
     git_dir = env.git[project]
@@ -35,20 +175,19 @@ def upload_release(project, version='HEAD'):
     if version != 'HEAD':
         ensure_branch_exists(version, git_dir)
 
+    if env.get('deploy_confirmed'):
+        return True
+
     deployment_src_str = (
         'git branch/tag `{}` of git repository {}'.format(version, git_dir)
         if version != 'HEAD'
         else 'HEAD of local git repository ({})'.format(git_dir))
 
     print green('\nAbout to deploy {} to {}'.format(
-        deployment_src_str, '|'.join(env.hosts)))
+        deployment_src_str, '|'.join(hosts)))
 
     msg = 'Continue?'
-    if not confirm(msg, default=False):
-        return
-
-    local('mkdir -p {}'.format(env.TMP_DIR))
-    upload_tar_from_git(project, git_dir, version)
+    return confirm(msg, default=False)
 
 
 def ensure_branch_exists(branch, git_dir):
@@ -65,15 +204,387 @@ def ensure_branch_exists(branch, git_dir):
 def upload_tar_from_git(project, git_dir, version):
     "Create an archive from the current Git branch and upload it."
     require('project_path', 'release', provided_by=ENVS)
-    with lcd(git_dir):
-        local('git archive --format=tar {_version} | '
-              'gzip > {TMP_DIR}/{release}.tar.gz'.format(
-                  _version=version, **env))
+
+    package = build_package(project, git_dir, version)
+    package_name = os.path.basename(package)
+    checksum = file_checksum(package)
+
+    with cd('{project_path}/{subdir}/packages'.format(subdir=project, **env)):
+        remote_checksum = run(
+            'sha256sum {} 2> /dev/null | cut -d " " -f 1'.format(package_name),
+            quiet=True)
+        if remote_checksum.strip() != checksum:
+            put(package, package_name)
+
     run('mkdir -p {project_path}/{subdir}/releases/{release}'.format(
         subdir=project, **env))
-    put('{TMP_DIR}/{release}.tar.gz'.format(**env),
-        '{project_path}/{subdir}/packages/'.format(subdir=project, **env))
     with cd('{project_path}/{subdir}/releases/{release}'.format(subdir=project,
                                                                 **env)):
-        run('tar zxf ../../packages/{release}.tar.gz'.format(**env))
-    local('rm {TMP_DIR}/{release}.tar.gz'.format(**env))
+        run('tar zxf ../../packages/{}'.format(package_name))
+
+
+def upload_rsync_from_git(project, git_dir, version):
+    """
+    Upload a new release with rsync, transferring only what changed.
+
+    Files that are identical in the current release are hard-linked into the
+    new one instead of being sent; changed files are sent as deltas against
+    their current versions. As with `cp -al`, linked files share their inodes
+    with the running release, so they must never be written to in place.
+    Unlike `cp -al`, only files in the package are linked, so nothing built
+    in the running release (node_modules, compiled files) is carried over.
+
+    Modification times are not kept: `git archive` stamps every file with the
+    commit time, and rsync only links files whose preserved attributes match,
+    so keeping them would stop any file from being linked after a new commit.
+    """
+    require('project_path', 'release', provided_by=ENVS)
+
+    export_dir = export_package(project, git_dir, version)
+
+    releases_dir = '{project_path}/{subdir}/releases'.format(
+        subdir=project, **env)
+    extra_opts = '--checksum'
+    if run('test -d {}/current'.format(releases_dir), quiet=True).succeeded:
+        extra_opts += ' --link-dest={}/current/'.format(releases_dir)
+
+    run('mkdir -p {}/{release}'.format(releases_dir, **env))
+    rsync_project(
+        remote_dir='{}/{release}/'.format(releases_dir, **env),
+        local_dir=export_dir + '/',
+        extra_opts=extra_opts,
+        default_opts='-rlphvz')
+
+
+def export_package(project, git_dir, version):
+    """
+    Return the path to a local directory holding a version of a git
+    repository, unpacked from its cached package.
+    """
+    package = build_package(project, git_dir, version)
+    export_dir = package[:-len('.tar.gz')]
+
+    if not os.path.isdir(export_dir):
+        tmp_export_dir = '{}.{}.tmp'.format(export_dir, os.getpid())
+        local('mkdir -p {0} && tar zxf {1} -C {0}'.format(
+            tmp_export_dir, package))
+        try:
+            os.rename(tmp_export_dir, export_dir)
+        except OSError as e:
+            # Another deploy unpacked the same package first
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            local('rm -rf {}'.format(tmp_export_dir))
+
+    return export_dir
+
+
+def build_package(project, git_dir, version):
+    """
+    Return the path to a gzipped tarball of a version of a git repository.
+
+    Packages are kept in a local cache, named by project and commit, so each
+    commit is only archived once however many hosts it is deployed to.
+    """
+    with lcd(git_dir):
+        commit = local('git rev-parse {}^{{commit}}'.format(version),
+                       capture=True)
+
+    local('mkdir -p {PACKAGE_CACHE_DIR}'.format(**env))
+    package = os.path.join(env.PACKAGE_CACHE_DIR,
+                           '{}-{}.tar.gz'.format(project, commit))
+
+    if not os.path.exists(package):
+        # pigz produces the same format as gzip, using every core
+        with warn_only():
+            has_pigz = local('command -v pigz', capture=True).succeeded
+        compressor = 'pigz' if has_pigz else 'gzip'
+
+        # Write to a temporary file first, so that a concurrent deploy never
+        # sees a partial package
+        tmp_package = '{}.{}.tmp'.format(package, os.getpid())
+        with lcd(git_dir):
+            local('git archive --format=tar {} | {} > {}'.format(
+                commit, compressor, tmp_package))
+        os.rename(tmp_package, package)
+
+    return package
+
+
+def file_checksum(filename):
+    "SHA-256 hex digest of a local file."
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def install_files(files):
+    """
+    Install local files on the current host with one upload and one remote
+    command, returning the remote paths of the files that changed.
+
+    `files` is a list of (local path, remote path, owner, mode, reload
+    command) tuples, where the owner is "user:group". The files are uploaded
+    in a single archive along with a script that moves each one into place
+    only if its contents, owner or mode differ from the installed file.
+
+    Files are installed in groups sharing a reload command (which may be
+    None), in the order the commands first appear. Each group's command is
+    run once, if any of its files changed, before the next group is
+    installed. If it fails, the group's previous files are put back and
+    nothing more is installed.
+    """
+    require('host', 'project_path', provided_by=ENVS)
+
+    groups = []
+    for i, (local_path, remote_path, owner, mode, reload_command) in \
+            enumerate(files):
+        install = '{} {} {} {:o}'.format(i, pipes.quote(remote_path), owner,
+                                        mode)
+        for command, installs in groups:
+            if command == reload_command:
+                installs.append(install)
+                break
+        else:
+            groups.append((reload_command, [install]))
+
+    script = [INSTALL_FILES_SCRIPT]
+    for reload_command, installs in groups:
+        script.append('changed=')
+        script += ['install_file {}'.format(args) for args in installs]
+        if reload_command:
+            script.append(
+                'if [ -n "$changed" ] && ! ({}); then\n{}\n    exit 1\nfi'
+                .format(reload_command, '\n'.join(
+                    '    restore_file {}'.format(args)
+                    for args in installs)))
+    script = '\n'.join(script) + '\n'
+
+    # Named uniquely, since several hosts may be deployed to at once
+    local('mkdir -p {}'.format(env.TMP_DIR))
+    fd, archive = tempfile.mkstemp(suffix='.tar.gz', dir=env.TMP_DIR)
+    os.close(fd)
+    with tarfile.open(archive, 'w:gz') as tar:
+        script_info = tarfile.TarInfo('install.sh')
+        script_info.size = len(script)
+        tar.addfile(script_info, StringIO(script))
+        for i, f in enumerate(files):
+            tar.add(f[0], arcname=str(i))
+
+    remote_archive = '{project_path}/conf/configs.tar.gz'.format(**env)
+    put(archive, remote_archive)
+    os.remove(archive)
+
+    output = sudo(
+        'staging=$(mktemp -d) && tar xzf {0} -C $staging && '
+        '(sh $staging/install.sh $staging; status=$?; '
+        'rm -rf $staging {0}; exit $status)'.format(remote_archive))
+
+    changed = [line.split(' ', 1)[1] for line in output.splitlines()
+               if line.startswith('changed ')]
+    if changed:
+        print green('Installed {} on {}'.format(', '.join(changed),
+                                                env.host))
+    else:
+        print 'Configuration on {} is up to date'.format(env.host)
+    return changed
+
+
+# Start of the script `install_files` runs, with the directory the archive
+# was unpacked in as its argument. Both functions take a file's number in the
+# archive, its remote path, owner and mode. A file that changes is first
+# copied aside, so that `restore_file` can put it back.
+INSTALL_FILES_SCRIPT = """\
+staging=$1
+
+install_file() {
+    if cmp -s "$staging/$1" "$2" &&
+            [ "$(stat -c '%U:%G %a' "$2" 2> /dev/null)" = "$3 $4" ]; then
+        return
+    fi
+    if [ -e "$2" ]; then
+        cp -p "$2" "$staging/$1.orig" || exit 1
+    fi
+    install -o "${3%:*}" -g "${3#*:}" -m "$4" "$staging/$1" "$2.tmp" &&
+        mv -f "$2.tmp" "$2" || exit 1
+    touch "$staging/$1.changed"
+    changed=1
+    echo "changed $2"
+}
+
+restore_file() {
+    [ -e "$staging/$1.changed" ] || return 0
+    if [ -e "$staging/$1.orig" ]; then
+        cp -p "$staging/$1.orig" "$2.tmp" && mv -f "$2.tmp" "$2"
+    else
+        rm -f "$2"
+    fi
+    echo "restored $2"
+}
+"""
+
+
+def run_stages(stages):
+    """
+    Run deploy stages for the current host, each as soon as the stages it
+    depends on have finished, alongside any others that are ready.
+
+    `stages` is a list of (name, function, names of dependencies) tuples.
+    Each stage runs in its own process, over its own SSH connection. If a
+    stage fails, no more are started, and the deploy is aborted once those
+    still running have finished.
+
+    Prints when each stage started and how long it took, marking the
+    critical path: the chain of dependencies that finished last. A stage
+    whose process dies without reporting back (killed, or crashed) has
+    failed.
+    """
+    results = multiprocessing.Queue()
+    pending = list(stages)
+    running = {}
+    launched = {}
+    exited = set()
+    finished = {}
+    failed = []
+    started = time.time()
+
+    while pending or running:
+        if not failed:
+            for stage in list(pending):
+                name, func, dependencies = stage
+                if all(dep in finished for dep in dependencies):
+                    pending.remove(stage)
+                    process = multiprocessing.Process(
+                        target=run_stage, args=(name, func, results))
+                    process.start()
+                    running[name] = process
+                    launched[name] = time.time()
+                    print green('Started {}'.format(name))
+
+        if not running:
+            break
+
+        try:
+            name, start, end, error = results.get(timeout=1)
+        except Queue.Empty:
+            # A process that has just exited may not have had its result
+            # read yet, so it only counts as dead on the next poll
+            for name, process in running.items():
+                if name in exited:
+                    running.pop(name).join()
+                    failed.append('{} (exited with code {})'.format(
+                        name, process.exitcode))
+                    print red('Failed {} after {:.1f}s'.format(
+                        name, time.time() - launched[name]))
+                elif not process.is_alive():
+                    exited.add(name)
+            continue
+
+        running.pop(name).join()
+        if error:
+            failed.append('{} ({})'.format(name, error))
+            print red('Failed {} after {:.1f}s'.format(name, end - start))
+        else:
+            finished[name] = (start, end)
+            print green('Finished {} in {:.1f}s'.format(name, end - start))
+
+    print_stage_times(stages, finished, started)
+
+    if failed:
+        abort(red('Failed on {}: {}'.format(env.host, ', '.join(failed))))
+    if pending:
+        abort(red('Stages with unknown or circular dependencies: {}'.format(
+            ', '.join(name for name, _, _ in pending))))
+
+
+def run_stage(name, func, results):
+    """
+    Run one stage in a child process of `run_stages`, sending its name, start
+    and end times, and any error to the `results` queue.
+    """
+    # The SSH connection inherited from the parent process belongs to it
+    connections.pop(normalize_to_string(env.host_string), None)
+
+    start = time.time()
+    error = None
+    try:
+        func()
+    except BaseException as e:
+        error = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        disconnect_all()
+    results.put((name, start, time.time(), error))
+
+
+def print_stage_times(stages, finished, started):
+    if not finished:
+        return
+
+    dependencies = dict((name, deps) for name, _, deps in stages)
+
+    critical_path = set()
+    name = max(finished, key=lambda name: finished[name][1])
+    while name:
+        critical_path.add(name)
+        name = max([dep for dep in dependencies[name] if dep in finished] or
+                   [None], key=lambda dep: finished[dep][1] if dep else 0)
+
+    print ''
+    print '{:<20} {:>8} {:>8}'.format('stage', 'start', 'seconds')
+    for name in sorted(finished, key=lambda name: finished[name][0]):
+        start, end = finished[name]
+        print '{:<20} {:>+8.1f} {:>8.1f} {}'.format(
+            name, start - started, end - start,
+            '*' if name in critical_path else '').rstrip()
+    print '\nTotal {:.1f}s (* marks the critical path)'.format(
+        max(end for _, end in finished.values()) - started)
+
+
+# Types of static files worth compressing ahead of time
+PRECOMPRESS_EXTENSIONS = ['js', 'css', 'svg', 'json', 'html', 'map', 'txt',
+                          'xml', 'ttf']
+
+
+def precompress_static(path):
+    """
+    Write gzip (and, if available, brotli) copies of the text files in a
+    directory next to the originals, for nginx's `gzip_static` and
+    `brotli_static`.
+
+    Compressed copies left by earlier deploys are deleted first if their
+    original has since been removed or changed (and may now be too small to
+    be compressed), so that nginx never serves them in its place.
+    """
+    def find_files(options, suffixes):
+        return r'find {} -type f {} \( {} \) -print0'.format(
+            path, options, ' -o '.join(
+                '-name "*.{}{}"'.format(extension, suffix)
+                for extension in PRECOMPRESS_EXTENSIONS
+                for suffix in suffixes))
+
+    if not exists(path):
+        return
+
+    # gzip and brotli give a compressed copy the original's modification time
+    run('{} | while IFS= read -r -d "" compressed; do '
+        'original="${{compressed%.*}}"; '
+        'if [ ! -f "$original" ] || [ "$original" -nt "$compressed" ]; then '
+        'rm -f "$compressed"; fi; done'.format(
+            find_files('', ['.gz', '.br'])))
+
+    originals = find_files('-size +1k', [''])
+    run('{} | xargs -0 -r -P $(nproc) gzip -9 -k -f'.format(originals))
+    run('if command -v brotli > /dev/null; then '
+        '{} | xargs -0 -r -P $(nproc) brotli -k -f -q 11; '
+        'fi'.format(originals))
+
+
+def percentile(values, pct):
+    "The `pct`th percentile of a list of numbers (nearest-rank method)."
+    if not values:
+        return None
+    values = sorted(values)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
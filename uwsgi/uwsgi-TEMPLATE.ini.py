@@ -3,14 +3,28 @@
 import sys
 
 template = """[uwsgi]
-plugins = python3
+plugins = {PLUGINS}
 
 chdir = {ROOT_DIR}/api/releases/current
-virtualenv = {ROOT_DIR}/api/venv
+virtualenv = {ROOT_DIR}/api/releases/current/venv
 module = wsgi:application
 
 master = true
-processes = 1
+master-fifo = {MASTER_FIFO}
+processes = {PROCESSES}
+threads = {THREADS}
+enable-threads = true
+thunder-lock = true
+
+# Load the application in each worker rather than in the master, so that
+# workers can be reloaded one at a time (chain reloading)
+lazy-apps = true
+
+# `chdir` only happens once, when the master starts, so reloaded workers would
+# still import the release that was current then. Import the application
+# through the `current` symlink instead, and move into it after every fork.
+pythonpath = {ROOT_DIR}/api/releases/current
+hook-post-fork = chdir:{ROOT_DIR}/api/releases/current
 
 # uid = {UWSGI_UID}
 # gid = {UWSGI_GID}
@@ -21,18 +35,118 @@ socket = /run/uwsgi/{HOST}.sock
 # chown-socket = {SOCKET_GID}:{SOCKET_UID}
 chmod-socket = {SOCKET_CHMOD}
 
+# Socket backlog (must not exceed net.core.somaxconn on the host)
+listen = {LISTEN}
+
+# Kill workers stuck on a single request, and recycle them periodically
+harakiri = {HARAKIRI}
+max-requests = {MAX_REQUESTS}
+
+# Large enough for our request headers (cookies, Accept, etc.)
+buffer-size = {BUFFER_SIZE}
+
+# Log the nginx request ID, start time and duration of every request, for
+# `fab logs.trace`
+log-format = %(addr) %(method) %(uri) => %(status) %(size) bytes start=%(tmsecs) msecs=%(msecs) request_id=%(var.HTTP_X_REQUEST_ID)
+
 vacuum = true
 
 die-on-term = true
 """
 
+cheaper_template = """
+# Adaptive process spawning: keep {CHEAPER} worker(s) around when idle and
+# spawn more (up to `processes`) as requests back up
+cheaper-algo = spare
+cheaper = {CHEAPER}
+cheaper-initial = {CHEAPER_INITIAL}
+cheaper-step = {CHEAPER_STEP}
+"""
+
+stats_template = """
+# Stats server, read by the metrics exporter
+stats = {STATS_SOCKET}
+memory-report = true
+"""
+
+response_cache_template = """
+# Cache anonymous GET responses for API documents requested with a type
+# suffix, keyed on path and Accept header and shared by every worker. `fab
+# reload_all_services` empties it.
+cache2 = name=api,items={CACHE_ITEMS},blocksize={CACHE_BLOCKSIZE},blocks={CACHE_BLOCKS},bitmap=1,purge_lru=1
+
+route-if-not = equal:${{REQUEST_METHOD}};GET goto:no-response-cache
+route-if-not = empty:${{HTTP_AUTHORIZATION}} goto:no-response-cache
+route-if = contains:${{HTTP_COOKIE}};sessionid goto:no-response-cache
+{CACHE_ROUTES}
+route-label = no-response-cache
+"""
+
+# Suffixes of the documents in the response cache, and their content types
+CACHED_SUFFIXES = [
+    ('json', 'application/json'),
+    ('jsonld', 'application/ld+json'),
+    ('ttl', 'text/turtle'),
+]
+
+cache_route_template = """route = \\.{SUFFIX}$ cache:key=${{REQUEST_URI}}|${{HTTP_ACCEPT}},name=api,content_type={CONTENT_TYPE}
+route = \\.{SUFFIX}$ cachestore:key=${{REQUEST_URI}}|${{HTTP_ACCEPT}},name=api,expires={CACHE_EXPIRES}"""
+
 if __name__ == '__main__':
-    print template.format(**{
+    template_dict = {
         'HOST': sys.argv[1],
         'ROOT_DIR': sys.argv[2],
         'UWSGI_GID': sys.argv[3],
         'UWSGI_UID': sys.argv[4],
         'SOCKET_GID': sys.argv[5],
         'SOCKET_UID': sys.argv[6],
-        'SOCKET_CHMOD': sys.argv[7]
-    })
+        'SOCKET_CHMOD': sys.argv[7],
+        'PROCESSES': sys.argv[8],
+        'THREADS': sys.argv[9],
+        'CHEAPER': sys.argv[10],
+        'CHEAPER_INITIAL': sys.argv[11],
+        'CHEAPER_STEP': sys.argv[12],
+        'LISTEN': sys.argv[13],
+        'HARAKIRI': sys.argv[14],
+        'MAX_REQUESTS': sys.argv[15],
+        'BUFFER_SIZE': sys.argv[16],
+        'MASTER_FIFO': sys.argv[17],
+        'METRICS': sys.argv[18] == 'True',
+        'STATS_SOCKET': sys.argv[19],
+        'CACHE': sys.argv[20] == 'True',
+        'CACHE_SIZE': sys.argv[21],
+        'CACHE_ITEMS': sys.argv[22],
+        'CACHE_BLOCKSIZE': sys.argv[23],
+        'CACHE_EXPIRES': sys.argv[24],
+    }
+
+    # The cache plugins provide the response cache's routing actions and the
+    # command `fab api.flush_response_cache` sends to empty it
+    plugins = ['python3']
+    if template_dict['CACHE']:
+        plugins += ['router_cache', 'cache']
+    template_dict['PLUGINS'] = ','.join(plugins)
+
+    conf = template.format(**template_dict)
+
+    # The cheaper subsystem needs at least one worker it can stop
+    if 0 < int(template_dict['CHEAPER']) < int(template_dict['PROCESSES']):
+        conf += cheaper_template.format(**template_dict)
+
+    if template_dict['METRICS']:
+        conf += stats_template.format(**template_dict)
+
+    if template_dict['CACHE']:
+        # CACHE_SIZE is in megabytes; every item takes at least one block
+        template_dict['CACHE_BLOCKS'] = max(
+            int(template_dict['CACHE_SIZE']) * 1024 * 1024 //
+            int(template_dict['CACHE_BLOCKSIZE']),
+            int(template_dict['CACHE_ITEMS']))
+        template_dict['CACHE_ROUTES'] = '\n'.join(
+            cache_route_template.format(SUFFIX=suffix,
+                                        CONTENT_TYPE=content_type,
+                                        **template_dict)
+            for suffix, content_type in CACHED_SUFFIXES)
+        conf += response_cache_template.format(**template_dict)
+
+    print conf
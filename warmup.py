@@ -0,0 +1,134 @@
+"""
+Warm up a freshly deployed site before it takes real traffic.
+"""
+
+import os
+from StringIO import StringIO
+from collections import defaultdict
+
+from fabric.api import *
+from fabric.colors import green, red
+
+from envs import ENVS
+import logs
+import utils
+
+
+# Lines at the end of the access log that URLs are sampled from
+LOG_LINES = 100000
+
+
+@task(default=True)
+def warmup():
+    """
+    Replay a list of URLs against the local site and report their latency.
+
+    URLs are read from `warmup_urls_file` if it exists, and otherwise sampled
+    from the most frequent successful GET requests in the host's
+    `nginx_json_access_log`.
+    Requests are made over the loopback interface, through nginx, so both the
+    renderer and the API (and any nginx cache) are warmed. The list is replayed
+    `warmup_rounds` times with up to `warmup_concurrency` requests at once.
+
+    Returns True if every request in the last round succeeded and their 95th
+    percentile latency was under `warmup_max_latency` seconds.
+    """
+    require('host', 'project_path', provided_by=ENVS)
+
+    paths = get_warmup_paths()
+    remote_urls_file = upload_warmup_urls(paths)
+
+    results = []
+    for i in range(env.warmup_rounds):
+        results = replay_urls(remote_urls_file)
+
+    if not results:
+        print red('Warmup failed (no requests were made)')
+        return False
+
+    print ''
+    for status, latency, url in sorted(results, key=lambda r: -r[1]):
+        print '{:>5} {:>8.3f}s  {}'.format(status, latency, url)
+
+    errors = [url for status, latency, url in results
+              if not 200 <= status < 400]
+    p95 = utils.percentile([latency for _, latency, _ in results], 95)
+
+    print ''
+    print 'Warmed {} URLs: p95 {:.3f}s, {} errors'.format(
+        len(results), p95 or 0, len(errors))
+
+    if errors or p95 > env.warmup_max_latency:
+        print red('Warmup failed (maximum p95 is {:.3f}s)'.format(
+            env.warmup_max_latency))
+        return False
+
+    print green('Warmup succeeded')
+    return True
+
+
+def get_warmup_paths():
+    "Paths to request during warmup."
+    urls_file = env.get('warmup_urls_file')
+    if urls_file and os.path.exists(urls_file):
+        with open(urls_file) as f:
+            paths = [line.strip() for line in f
+                     if line.strip() and not line.startswith('#')]
+    else:
+        # The log is only readable by root, so it is read with sudo
+        require('nginx_json_access_log', provided_by=ENVS)
+        counts = defaultdict(int)
+        logs.stream_output(
+            'tail -n {} {}'.format(LOG_LINES, env.nginx_json_access_log),
+            logs.parse_entries(count_paths(counts)))
+        paths = sorted(counts, key=lambda path: -counts[path])
+        paths = paths[:env.warmup_sample_size]
+
+    return paths or ['/']
+
+
+@logs.coroutine
+def count_paths(counts):
+    "Count successful GET requests in the access log by path."
+    while True:
+        entry = (yield)
+        if entry.get('method') == 'GET' and entry.get('status') == '200':
+            counts[entry['uri'].encode('utf-8')] += 1
+
+
+def upload_warmup_urls(paths):
+    "Upload the full URLs for a list of paths, returning the remote filename."
+    scheme = 'https' if env.get('ssl_conf_file') else 'http'
+    remote_urls_file = os.path.join(env.project_path, 'conf',
+                                    'warmup-urls.txt')
+
+    # Uploaded from memory, since hosts may be deployed to at once
+    urls = ''.join('{}://{}{}\n'.format(scheme, env.host, path)
+                   for path in paths)
+    put(StringIO(urls), remote_urls_file)
+    return remote_urls_file
+
+
+def replay_urls(remote_urls_file):
+    """
+    Request every URL in a remote file, returning a list of
+    (status, latency in seconds, url) tuples.
+    """
+    port = 443 if env.get('ssl_conf_file') else 80
+
+    # Requests accept HTML, so that paths without a type suffix are rendered
+    output = run(
+        'xargs -a {urls} -d "\\n" -n 1 -P {concurrency} '
+        'curl -s -o /dev/null --max-time 60 '
+        '--resolve {host}:{port}:127.0.0.1 '
+        '-H "Accept: text/html" '
+        '-w "%{{http_code}} %{{time_total}} %{{url_effective}}\\n"'.format(
+            urls=remote_urls_file, concurrency=env.warmup_concurrency,
+            host=env.host, port=port),
+        quiet=True)
+
+    results = []
+    for line in output.splitlines():
+        status, latency, url = line.split(' ', 2)
+        results.append((int(status), float(latency), url))
+    return results